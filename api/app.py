@@ -1,15 +1,31 @@
+import asyncio
+import hashlib
+import io
 import json
 import pprint
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from httpx import Timeout
 import pandas as pd
-from metrics import getTable, gettable, METRICS_MAP, compute_metric
-from sqlmodel import Field, Session, SQLModel, create_engine, select, insert, delete
+from metrics import getTable, gettable, iter_table, keyword_table, table_cursor, METRICS_MAP, ORDER_FIELDS, TABLE_HEADERS, plan_compute
+from jobs import JobManager
+from similarity import snapshot_index
+from sqlmodel import Field, Session, create_engine, select, insert, delete
 from typing import List
-from models import Agency
-from datetime import datetime
+from models import Agency, create_db_and_tables as create_schema, create_read_engine, enable_wal, get_data_version
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
 
 BASE_URL = "https://www.ecfr.gov/api"
@@ -18,11 +34,27 @@ custom_timeout = Timeout(connect=15.0, read=120.0, write=5.0, pool=True)
 sqlite_file_name = "./api/ecfr.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+# writes (metric computation) go through `engine`; query endpoints read through
+# a pool of read-only connections, which WAL keeps from blocking on the writer
+engine = enable_wal(create_engine(sqlite_url, echo=False, connect_args=connect_args))
+READ_POOL_SIZE = 8
+read_engine = create_read_engine(sqlite_file_name, pool_size=READ_POOL_SIZE)
+# blocking DB work runs in dedicated threads: one per pooled read connection, and a
+# single writer thread so long computations never take threads from the queries
+read_executor = ThreadPoolExecutor(READ_POOL_SIZE, thread_name_prefix="ecfr-read")
+write_executor = ThreadPoolExecutor(1, thread_name_prefix="ecfr-write")
+# ingestion and metric computation run as background jobs on the writer thread
+job_manager = JobManager(engine, write_executor)
+
+
+async def run_blocking(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    """Run a blocking call on `executor` without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # also adds later indexes and the keyword index to an existing database
+    create_schema(engine)
 
 app = FastAPI()
 
@@ -38,60 +70,334 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified", "X-Next-Cursor"],
 )
 
+
+class ResponseCache:
+    """In-process LRU cache of rendered query responses.
+
+    Entries are keyed on the normalized query and remember the data version
+    they were built from; an entry from an older version (or older than
+    `ttl` seconds) is treated as a miss.
+    """
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def _query_key(kind: str, metric_name: str, level: int, start_dt: datetime, end_dt: datetime, agency_list: List[str],
+               page: dict = None):
+    return (kind, metric_name, level, start_dt.isoformat(), end_dt.isoformat(), tuple(sorted(set(agency_list))),
+            tuple(sorted((page or {}).items())))
+
+
+def _validators(key, version: int, updated_at: datetime) -> dict:
+    """ETag and Last-Modified headers for a query at a data version."""
+    etag = hashlib.sha1(repr((version, key)).encode("utf-8")).hexdigest()[:20]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if updated_at is not None:
+        headers["Last-Modified"] = format_datetime(updated_at.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+
+def _not_modified(request: Request, headers: dict) -> bool:
+    """True when the client's conditional headers still match `headers`."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return headers["ETag"] in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            return parsedate_to_datetime(headers["Last-Modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _cached_response(request: Request, kind: str, metric_name: str, level: int, start_dt: datetime, end_dt: datetime,
+                     agency_list: List[str], render, media_type: str, page: dict = None):
+    """Serve a query from `response_cache`, answering 304 when the client copy is current.
+
+    `render()` builds the serialized response body and any extra headers on a miss.
+    """
+    version, updated_at = get_data_version(read_engine)
+    key = _query_key(kind, metric_name, level, start_dt, end_dt, agency_list, page)
+    headers = _validators(key, version, updated_at)
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    cached = response_cache.get(key, version)
+    if cached is None:
+        cached = render()
+        response_cache.put(key, version, cached)
+    body, extra_headers = cached
+    return Response(content=body, media_type=media_type, headers={**headers, **extra_headers})
+
+
+def _ndjson_chunks(chunks):
+    for chunk in chunks:
+        yield "".join(json.dumps(dict(zip(TABLE_HEADERS, row))) + "\n" for row in chunk)
+
+
+def _column_chunks(chunks):
+    """One JSON object of column arrays per chunk, newline-delimited."""
+    for chunk in chunks:
+        yield json.dumps(dict(zip(TABLE_HEADERS, map(list, zip(*chunk))))) + "\n"
+
+
+def _arrow_chunks(chunks):
+    """An Arrow IPC stream with one record batch per chunk; repeated labels are dictionary-encoded."""
+    label = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([("agency_slug", label), ("Title", label), ("Level_Name", label),
+                        ("Level", pa.string()), ("Date", label), ("Value", pa.float64())])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for chunk in chunks:
+            columns = [list(column) for column in zip(*chunk)]
+            columns[3] = [None if value is None else str(value) for value in columns[3]]
+            arrays = [pa.array(values, type=field.type) if field.type != label else pa.array(values).dictionary_encode()
+                      for values, field in zip(columns, schema)]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+# streamed formats for /metric_json/: (media type, chunk encoder)
+STREAM_FORMATS = {
+    "ndjson": ("application/x-ndjson", _ndjson_chunks),
+    "columns": ("application/x-ndjson", _column_chunks),
+    "arrow": ("application/vnd.apache.arrow.stream", _arrow_chunks),
+}
+
+
+def _streamed_response(request: Request, kind: str, metric_name: str, level: int, start_dt: datetime, end_dt: datetime,
+                       agency_list: List[str], page: dict = None):
+    """Stream a query in `kind` format chunk by chunk; nothing is cached, but 304s still apply."""
+    version, updated_at = get_data_version(read_engine)
+    key = _query_key(kind, metric_name, level, start_dt, end_dt, agency_list, page)
+    headers = _validators(key, version, updated_at)
+    if _not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    media_type, encode = STREAM_FORMATS[kind]
+    chunks = iter_table(read_engine, metric_name, agency_list, level, start_dt, end_dt, **(page or {}))
+    return StreamingResponse(encode(chunks), media_type=media_type, headers=headers)
+
+
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
     
  
 @app.get("/metric/", response_class=HTMLResponse)
-def get_metric_table(metric_name: str, level: int, start_dt: datetime, end_dt: datetime, agencies: str = "BIA"):
+async def get_metric_table(request: Request, metric_name: str, level: int, start_dt: datetime, end_dt: datetime, agencies: str = "BIA"):
     """Return an HTML table for the named metric.
 
     Query params: `metric_name`, `level`, `start_dt`, `end_dt`, `agencies` (comma-separated slugs; default "BIA").
+    Responses are cached until the data changes and carry ETag/Last-Modified.
     """
     # validate metric name
     if metric_name not in METRICS_MAP:
         return HTMLResponse(content=f"Unknown metric: {metric_name}", status_code=400)
 
     agency_list = [a.strip() for a in agencies.split(",")]
-    rows = gettable(engine, metric_name, agency_list, level, start_dt, end_dt)
-    df = pd.DataFrame(rows)
-    html_table = df.to_html(index=False, border=1)
-    return f"""
+
+    def render():
+        rows = gettable(read_engine, metric_name, agency_list, level, start_dt, end_dt)
+        df = pd.DataFrame(rows)
+        html_table = df.to_html(index=False, border=1)
+        return f"""
     <html>
         <head><title>FastAPI HTML</title></head>
         <body>{html_table}</body>
     </html>
-    """
+    """, {}
+
+    return await run_blocking(read_executor, _cached_response, request, "html", metric_name, level, start_dt, end_dt,
+                              agency_list, render, "text/html")
 
 
 @app.get("/metric_json/")
-def get_metric_json(metric_name: str, level: int, start_dt: datetime, end_dt: datetime, agencies: str = "BIA"):
+async def get_metric_json(request: Request, metric_name: str, level: int, start_dt: datetime, end_dt: datetime, agencies: str = "BIA",
+                          format: str = "json", order_by: str = None, limit: int = None, after: str = None, top_n: int = None):
     """Return JSON list-of-dicts using `gettable` from `metrics.py`.
 
-    Query params: `metric_name`, `level`, `start_dt`, `end_dt` (ISO dates), `agencies` (comma-separated slugs; default "BIA").
+    Query params: `metric_name`, `level`, `start_dt`, `end_dt` (ISO dates), `agencies` (comma-separated slugs; default "BIA"),
+    `format`: "json" (default), or a streamed format: "ndjson" (one row object per line),
+    "columns" (one object of column arrays per chunk of rows, per line) or "arrow" (Arrow IPC stream, needs pyarrow).
+    `order_by` (value, agency, title, level or date; "-" prefix for descending), `limit`, `after` (cursor) and
+    `top_n` (largest N values per date) are evaluated in SQL. When a "json" page is full, the cursor for the next
+    page is returned in the X-Next-Cursor header.
+    Responses carry ETag/Last-Modified; "json" responses are also cached until the data changes.
     """
     if metric_name not in METRICS_MAP:
         return {"error": f"Unknown metric: {metric_name}"}
+    if format != "json" and format not in STREAM_FORMATS:
+        return {"error": f"Unknown format: {format}. Available: {['json', *STREAM_FORMATS]}"}
+    if format == "arrow" and pa is None:
+        return {"error": "The arrow format needs pyarrow installed"}
+    if order_by is not None and order_by.lstrip("-") not in ORDER_FIELDS:
+        return {"error": f"Unknown order_by: {order_by}. Available: {list(ORDER_FIELDS)} (prefix '-' for descending)"}
+    if (limit is not None and limit < 1) or (top_n is not None and top_n < 1):
+        return {"error": "limit and top_n must be positive"}
+    agency_list = [a.strip() for a in agencies.split(",")]
+    page = {name: value for name, value in dict(order_by=order_by, limit=limit, after=after, top_n=top_n).items()
+            if value is not None}
+    try:
+        if format != "json":
+            return await run_blocking(read_executor, _streamed_response, request, format, metric_name, level, start_dt, end_dt,
+                                      agency_list, page)
+
+        def render():
+            # fetch one extra row to know whether another page follows
+            query_page = {**page, "limit": limit + 1} if limit is not None else page
+            rows = gettable(read_engine, metric_name, agency_list, level, start_dt, end_dt, **query_page)
+            headers = {}
+            if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                headers["X-Next-Cursor"] = table_cursor(rows[-1], order_by)
+            return json.dumps(rows), headers
+
+        return await run_blocking(read_executor, _cached_response, request, "json", metric_name, level, start_dt, end_dt,
+                                  agency_list, render, "application/json", page)
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+@app.get("/keyword_metric/")
+async def get_keyword_metric(request: Request, terms: str, level: int, start_dt: datetime, end_dt: datetime, agencies: str = "BIA"):
+    """Return hit counts of words or phrases, grouped like `/metric_json/`.
+
+    Query params: `terms` (comma-separated words or phrases, e.g. "shall,shall not"), `level`, `start_dt`, `end_dt`
+    (ISO dates), `agencies` (comma-separated slugs; default "BIA").
+    Counts are case-insensitive whole-word matches read from the FTS5 keyword index, one row per term and group.
+    Responses are cached until the data changes and carry ETag/Last-Modified.
+    """
+    term_list = [term.strip() for term in terms.split(",") if term.strip()]
+    if not term_list:
+        return {"error": "terms must list at least one word or phrase"}
     agency_list = [a.strip() for a in agencies.split(",")]
-    rows = gettable(engine, metric_name, agency_list, level, start_dt, end_dt)
-    return rows
+
+    def render():
+        return json.dumps(keyword_table(read_engine, term_list, agency_list, level, start_dt, end_dt)), {}
+
+    try:
+        return await run_blocking(read_executor, _cached_response, request, "keyword", ",".join(term_list), level,
+                                  start_dt, end_dt, agency_list, render, "application/json")
+    except ValueError as e:
+        return {"error": str(e)}
+
+
+@app.get("/similar_sections/")
+async def similar_sections(request: Request, title_id: int, section_id: str, issue_date: datetime,
+                           threshold: float = 0.5, limit: int = 20, agencies: str = None):
+    """Return the sections most similar to one section, across titles and agencies.
+
+    Query params: `title_id`, `section_id`, `issue_date` (the CFR as of this date: each title's latest snapshot
+    on or before it), `threshold` (minimum estimated Jaccard similarity, default 0.5), `limit` (default 20),
+    `agencies` (optional comma-separated slugs to restrict the matches to).
+    Matches come from the MinHash/LSH index, so pairs below about 0.4 may be missed.
+    Responses are cached until the data changes and carry ETag/Last-Modified.
+    """
+    if not 0 <= threshold <= 1 or limit < 1:
+        return JSONResponse({"error": "threshold must be between 0 and 1 and limit positive"}, status_code=400)
+    agency_list = [a.strip() for a in agencies.split(",")] if agencies else []
+
+    def render():
+        index = snapshot_index(read_engine, issue_date)
+        matches = index.similar(title_id, section_id, threshold, limit, agency_list)
+        if matches is None:
+            return json.dumps({"error": f"Section {section_id} of title {title_id} is not in the CFR as of "
+                                        f"{issue_date:%Y-%m-%d}"}), {}
+        return json.dumps({"title_id": title_id, "section_id": section_id, "issue_date": issue_date.isoformat(),
+                           "similar": matches}), {}
+
+    return await run_blocking(read_executor, _cached_response, request, "similar", f"{title_id}:{section_id}", 0,
+                              issue_date, issue_date, agency_list, render, "application/json",
+                              dict(threshold=threshold, limit=limit))
 
 
 @app.post("/compute_metrics/")
-def compute_metrics(title_id: int, start_dt: datetime, end_dt: datetime):
-    """Trigger metric computation for a title and date range.
+async def compute_metrics(title_id: int, start_dt: datetime, end_dt: datetime, workers: int = 1, dry_run: bool = False):
+    """Queue metric computation for a title and date range as a background job.
     
-    Query params: `title_id`, `start_dt`, `end_dt` (ISO dates).
-    Computes all metrics for all sections in the date range and writes to DB.
-    Returns status message upon completion.
+    Query params: `title_id`, `start_dt`, `end_dt` (ISO dates), `workers` (default 1), `dry_run`.
+    Returns the job right away; follow it with `GET /jobs/{id}`. Dates whose
+    metrics are already complete are skipped. With `workers` > 1 the dates are
+    split across a process pool. With `dry_run` nothing is queued; the issue
+    dates that would be processed are returned instead.
     """
     try:
-        compute_metric(engine, title_id, start_dt, end_dt)
-        return {"status": "success", "message": f"Computed metrics for title {title_id} from {start_dt} to {end_dt}"}
+        if dry_run:
+            plan = await run_blocking(read_executor, plan_compute, read_engine, [title_id], start_dt, end_dt)
+            return {"status": "dry_run", "dates": len(plan), "pending": sum(not shard["done"] for shard in plan),
+                    "sections": sum(shard["sections"] for shard in plan), "plan": plan}
+        job = job_manager.submit("compute", title_id, start_dt, end_dt, workers=workers)
+        return {"status": "queued", "job_id": job.id, "job": job.to_dict()}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+@app.post("/ingest/")
+async def ingest(title_id: int, start_dt: datetime, end_dt: datetime):
+    """Queue ingestion of the downloaded XML snapshots of a title in a date range.
+
+    Query params: `title_id`, `start_dt`, `end_dt` (ISO dates).
+    Snapshots are loaded oldest first with `process_title_xml_incremental`;
+    dates that already have text are skipped. Returns the job right away.
+    """
+    job = job_manager.submit("ingest", title_id, start_dt, end_dt)
+    return {"status": "queued", "job_id": job.id, "job": job.to_dict()}
+
+
+@app.get("/jobs/")
+async def list_jobs():
+    """Return every queued, running and recently finished job."""
+    return [job.to_dict() for job in job_manager.all()]
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return a job's status and progress: dates done, sections/s and ETA in seconds."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse({"error": f"Unknown job: {job_id}"}, status_code=404)
+    return job.to_dict()
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a job. A queued job never starts; a running one stops after its current date."""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return JSONResponse({"error": f"Unknown job: {job_id}"}, status_code=404)
+    return job.to_dict()
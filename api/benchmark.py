@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the parse, ingest, compute and query stages.
+
+Usage:
+  From repo root:
+    python api/benchmark.py [--scale N] [--snapshots N] [--out FILE] [--baseline FILE]
+
+Runs against the bundled api/xml_data/title1 snapshots. `--scale N` first
+writes an inflated copy of every snapshot with each part repeated N times
+(renumbered, with its own section bodies) to stand in for a large title.
+Everything goes to a temporary directory and SQLite database; nothing is
+downloaded.
+
+Stages, each in a fresh process so its peak RSS is its own (each stage
+reads what the one before it wrote, so a subset should start from ingest):
+  parse         TitleXMLParser over every snapshot        (latency per file)
+  parse_stream  StreamingTitleXMLParser over every snapshot (latency per file)
+  ingest        process_title_xml for every snapshot      (latency per file)
+  compute       compute_metric over the whole range       (latency per shard)
+  query         getTable per metric and level             (latency per query)
+
+Results are written as JSON. With `--baseline` they are compared to an
+earlier run's JSON, and the exit status is 1 if any stage regressed by
+more than `--tolerance`.
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from parser import open_xml, xml_files
+
+XML_DIR = "./api/xml_data"
+TITLE_ID = 1
+# copy k of part N is numbered N + k * PART_OFFSET; real part numbers stay below it
+PART_OFFSET = 10000
+STAGES = ("parse", "parse_stream", "ingest", "compute", "query")
+QUERY_METRICS = ["Word count", "cross-references Average", "Citation depth", "Term: shall"]
+QUERY_LEVELS = range(6)
+# compared against a baseline: (key, higher is better)
+COMPARED = [("per_s", True), ("p50_ms", False), ("p99_ms", False), ("peak_rss_mb", False)]
+
+
+def inflate_snapshot(src_path: str, dst_path: str, scale: int):
+    """Write `src_path` to `dst_path` with every part repeated `scale` times.
+
+    Copy k of part N becomes part N + k * PART_OFFSET, and its sections are
+    renumbered the same way, so section ids stay unique. Each copied section
+    gets one extra paragraph naming its copy, so copies have distinct bodies
+    and are not deduplicated by content hash. The output is deterministic,
+    and a section unchanged between two snapshots stays unchanged in every copy.
+    """
+    with open_xml(src_path) as f:
+        tree = ET.parse(f)
+    parts = [(parent, child) for parent in tree.iter() for child in parent if child.get("TYPE") == "PART"]
+    for k in range(1, scale):
+        for parent, part in parts:
+            parent.append(_renumbered(part, k))
+    with open_xml(dst_path, "wb") as f:
+        tree.write(f, encoding="UTF-8", xml_declaration=True)
+
+
+def _renumbered(part, k: int):
+    part = copy.deepcopy(part)
+    for elem in part.iter():
+        kind = elem.get("TYPE")
+        if kind not in ("PART", "SECTION"):
+            continue
+        number = elem.get("N") or ""
+        shifted = _shift(number, k)
+        elem.set("N", shifted)
+        head = next((child for child in elem if child.tag.startswith("HEAD")), None)
+        if head is not None and head.text:
+            head.text = head.text.replace(number, shifted, 1)
+        if kind == "SECTION":
+            ET.SubElement(elem, "P").text = f"Synthetic copy {k} of § {number}."
+    return part
+
+
+def _shift(number: str, k: int) -> str:
+    match = re.match(r"(\d+)(.*)", number, re.S)
+    return f"{int(match.group(1)) + k * PART_OFFSET}{match.group(2)}" if match else f"{number}-{k}"
+
+
+def prepare_dataset(work_dir: str, scale: int = 1, snapshots: int = None) -> dict:
+    """Select (and for `scale` > 1 inflate) the title 1 snapshots; returns the run manifest."""
+    sources = xml_files(f"{XML_DIR}/title{TITLE_ID}")
+    if snapshots:
+        sources = sources[:snapshots]
+    xml_dir = os.path.abspath(XML_DIR)
+    if scale > 1:
+        xml_dir = os.path.join(work_dir, "xml_data")
+        os.makedirs(os.path.join(xml_dir, f"title{TITLE_ID}"))
+        for src_path in sources:
+            inflate_snapshot(src_path, os.path.join(xml_dir, f"title{TITLE_ID}", os.path.basename(src_path)), scale)
+    files = [os.path.join(xml_dir, f"title{TITLE_ID}", os.path.basename(path)) for path in sources]
+    chapters = set()
+    for file_path in files:
+        with open_xml(file_path) as f:
+            for _, elem in ET.iterparse(f):
+                if elem.get("TYPE") == "CHAPTER":
+                    chapters.add(elem.get("N"))
+                    elem.clear()
+    return dict(
+        xml_dir=xml_dir,
+        files=files,
+        dates=[datetime.strptime(os.path.basename(path).rsplit("_", 1)[1][:10], "%Y-%m-%d").isoformat() for path in files],
+        bytes=sum(os.path.getsize(path) for path in files),
+        chapters=sorted(chapters),
+        db_url=f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+    )
+
+
+def _agencies(chapters: list) -> list:
+    """One agency per chapter, in the eCFR /agencies.json shape `load_agencies` reads."""
+    return [dict(slug=f"bench-chapter-{chapter.lower()}", name=f"Chapter {chapter}", short_name=f"CH{chapter}",
+                 display_name=f"Chapter {chapter}", sortable_name=f"Chapter {chapter}",
+                 cfr_references=[dict(title=TITLE_ID, chapter=chapter)], children=[])
+            for chapter in chapters]
+
+
+def _parse_stage(manifest: dict, parser_class) -> tuple:
+    sections = 0
+    latencies = []
+    for file_path in manifest["files"]:
+        start = time.perf_counter()
+        sections += sum(1 for _ in parser_class(file_path))
+        latencies.append(time.perf_counter() - start)
+    return sections, latencies
+
+
+def run_parse(manifest: dict) -> tuple:
+    from parser import TitleXMLParser
+    return _parse_stage(manifest, TitleXMLParser)
+
+
+def run_parse_stream(manifest: dict) -> tuple:
+    from parser import StreamingTitleXMLParser
+    return _parse_stage(manifest, StreamingTitleXMLParser)
+
+
+def run_ingest(manifest: dict) -> tuple:
+    import fetch_data
+    from models import create_db_and_tables
+    from sqlmodel import create_engine
+
+    fetch_data.XML_Data_DIR = manifest["xml_dir"]
+    engine = create_engine(manifest["db_url"])
+    create_db_and_tables(engine)
+    fetch_data.load_agencies(engine, _agencies(manifest["chapters"]))
+    sections = 0
+    latencies = []
+    for issue_date in manifest["dates"]:
+        start = time.perf_counter()
+        sections += fetch_data.process_title_xml(engine, TITLE_ID, datetime.fromisoformat(issue_date)) or 0
+        latencies.append(time.perf_counter() - start)
+    return sections, latencies
+
+
+def run_compute(manifest: dict) -> tuple:
+    from metrics import compute_metric
+    from sqlmodel import create_engine
+
+    engine = create_engine(manifest["db_url"])
+    latencies = []
+    last = [time.perf_counter()]
+
+    def progress(title_id, issue_date, rows):
+        now = time.perf_counter()
+        latencies.append(now - last[0])
+        last[0] = now
+
+    start, end = datetime.fromisoformat(manifest["dates"][0]), datetime.fromisoformat(manifest["dates"][-1])
+    stats = compute_metric(engine, TITLE_ID, start, end, progress=progress)
+    return stats["rows"], latencies
+
+
+def run_query(manifest: dict, repeat: int = 5) -> tuple:
+    from metrics import METRICS_MAP, getTable
+    from sqlmodel import create_engine
+
+    engine = create_engine(manifest["db_url"])
+    agencies = [agency["short_name"] for agency in _agencies(manifest["chapters"])]
+    start, end = datetime.fromisoformat(manifest["dates"][0]), datetime.fromisoformat(manifest["dates"][-1])
+    rows = 0
+    latencies = []
+    for _ in range(repeat):
+        for name in QUERY_METRICS:
+            for level in QUERY_LEVELS:
+                started = time.perf_counter()
+                rows += len(getTable(engine, METRICS_MAP[name], agencies, level, start, end))
+                latencies.append(time.perf_counter() - started)
+    return rows, latencies
+
+
+STAGE_RUNNERS = {"parse": run_parse, "parse_stream": run_parse_stream, "ingest": run_ingest,
+                 "compute": run_compute, "query": run_query}
+STAGE_UNITS = {"parse": "sections", "parse_stream": "sections", "ingest": "sections",
+               "compute": "metric rows", "query": "rows"}
+
+
+def _stage_worker(stage: str, manifest: dict) -> dict:
+    # the stages print progress per file/shard; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        count, latencies = STAGE_RUNNERS[stage](manifest)
+    # only the timed units count, not setup such as creating the schema
+    seconds = sum(latencies)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak_mb = peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+    result = dict(unit=STAGE_UNITS[stage], count=count, seconds=round(seconds, 4),
+                  per_s=round(count / seconds, 1) if seconds else None,
+                  peak_rss_mb=round(peak_mb, 1), samples=len(latencies))
+    result.update({f"{name}_ms": round(value * 1000, 3) for name, value in percentiles(latencies).items()})
+    if stage.startswith("parse"):
+        result["mb_per_s"] = round(manifest["bytes"] / (1 << 20) / seconds, 2)
+    return result
+
+
+def percentiles(samples: list) -> dict:
+    """p50/p90/p99/max of `samples`, linearly interpolated between ranks."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(q):
+        position = (len(ordered) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": ordered[-1]}
+
+
+def run_benchmark(scale: int = 1, snapshots: int = None, stages=STAGES) -> dict:
+    """Run the stages in order on a fresh temporary database; returns the JSON report."""
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        manifest = prepare_dataset(work_dir, scale, snapshots)
+        report = dict(meta=_meta(manifest, scale), stages={})
+        for stage in stages:
+            # later stages read the database the earlier ones wrote
+            with context.Pool(1) as pool:
+                report["stages"][stage] = pool.apply(_stage_worker, (stage, manifest))
+            print(_format_stage(stage, report["stages"][stage]))
+    return report
+
+
+def _meta(manifest: dict, scale: int) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(created_at=datetime.now().isoformat(timespec="seconds"), commit=commit or None,
+                python=platform.python_version(), sqlite=sqlite3.sqlite_version, platform=platform.platform(),
+                cpus=os.cpu_count(), title_id=TITLE_ID, scale=scale, snapshots=len(manifest["files"]),
+                xml_mb=round(manifest["bytes"] / (1 << 20), 2))
+
+
+def _format_stage(stage: str, result: dict) -> str:
+    line = (f"{stage:>12}: {result['count']} {result['unit']} in {result['seconds']:.2f}s "
+            f"({result['per_s']:.0f}/s) | peak RSS {result['peak_rss_mb']:.0f} MB")
+    if "p50_ms" in result:
+        line += f" | p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms over {result['samples']}"
+    return line
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """Print each stage against `baseline`; returns the (stage, key) pairs worse by more than `tolerance`."""
+    for key in ("scale", "snapshots"):
+        if report["meta"].get(key) != baseline["meta"].get(key):
+            print(f"warning: baseline {key} is {baseline['meta'].get(key)}, this run {report['meta'].get(key)}")
+    regressions = []
+    for stage, result in report["stages"].items():
+        old = baseline["stages"].get(stage)
+        if old is None:
+            continue
+        changes = []
+        for key, higher_is_better in COMPARED:
+            if not old.get(key) or result.get(key) is None:
+                continue
+            ratio = result[key] / old[key]
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            if worse:
+                regressions.append((stage, key))
+            changes.append(f"{key} {ratio:.2f}x{' REGRESSION' if worse else ''}")
+        print(f"{stage:>12}: " + ", ".join(changes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parse, ingest, compute and query stages.")
+    parser.add_argument("--scale", type=int, default=1, help="repeat every part N times (default 1: bundled data)")
+    parser.add_argument("--snapshots", type=int, default=None, help="only use the first N snapshots")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--out", default="benchmark.json", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {sorted(unknown)}. Available: {list(STAGES)}")
+    report = run_benchmark(args.scale, args.snapshots, stages)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, create_engine
+from models import CfrContent, CfrDimension, CfrText, create_db_and_tables
+
+WRITE_MODES = ("insert", "ignore", "upsert")
+
+
+class BulkWriter:
+    """Buffer plain row dicts per table and write them with executemany.
+
+    Rows are written on one connection inside a single transaction that is
+    committed by `commit()` or when the `with` block exits, or dropped by
+    `rollback()`, so a whole file can be loaded atomically. Each flush runs in a savepoint: in the default
+    "insert" mode a failing batch is skipped with a warning, "ignore" uses
+    INSERT OR IGNORE so duplicates are dropped row by row, and "upsert"
+    replaces the non-key columns of existing rows.
+    """
+    def __init__(self, engine, batch_size: int = 1000, mode: str = "insert"):
+        _check_mode(mode)
+        self.engine = engine
+        self.batch_size = batch_size
+        self.mode = mode
+        self.written = 0
+        self.failed = 0
+        self._buffers = {}
+        self._statements = {}
+        self._conn = None
+        self._trans = None
+
+    def __enter__(self):
+        self._conn = self.engine.connect()
+        self._trans = self._conn.begin()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+                self._trans.commit()
+            else:
+                self._trans.rollback()
+        finally:
+            self._conn.close()
+            self._conn = None
+        return False
+
+    def add(self, model, row: dict, mode: str = None):
+        """Queue one row for `model` (a SQLModel table class).
+
+        `mode` overrides the writer's mode for this table, e.g. "ignore" for
+        shared rows that other files may already have written.
+        """
+        if mode is not None:
+            _check_mode(mode)
+        rows = self._buffers.setdefault((model.__table__, mode or self.mode), [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, model, rows: list, mode: str = None):
+        """Queue a list of row dicts for `model`, flushing every `batch_size` rows."""
+        if mode is not None:
+            _check_mode(mode)
+        key = (model.__table__, mode or self.mode)
+        for start in range(0, len(rows), self.batch_size):
+            buffered = self._buffers.setdefault(key, [])
+            buffered.extend(rows[start:start + self.batch_size])
+            if len(buffered) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Write all buffered rows in one savepoint."""
+        batches = [(key, rows) for key, rows in self._buffers.items() if rows]
+        self._buffers = {}
+        if not batches:
+            return
+        savepoint = self._conn.begin_nested()
+        try:
+            for key, rows in batches:
+                self._conn.execute(self._statement(*key), rows)
+            savepoint.commit()
+            self.written += sum(len(rows) for _, rows in batches)
+        except Exception as e:
+            savepoint.rollback()
+            self.failed += sum(len(rows) for _, rows in batches)
+            print(f"Warning: Batch insert failed (likely duplicates): {e}")
+
+    def execute(self, statement, params=None):
+        """Flush buffered rows, then run `statement` in the same transaction."""
+        self.flush()
+        return self._conn.execute(statement, params)
+
+    def commit(self):
+        """Flush and commit the current transaction, then start a new one."""
+        self.flush()
+        self._trans.commit()
+        self._trans = self._conn.begin()
+
+    def rollback(self):
+        """Drop buffered rows and roll back the current transaction, then start a new one."""
+        self._buffers = {}
+        self._trans.rollback()
+        self._trans = self._conn.begin()
+
+    def _statement(self, table, mode):
+        if (table, mode) not in self._statements:
+            self._statements[(table, mode)] = _insert_statement(table, mode)
+        return self._statements[(table, mode)]
+
+
+def _check_mode(mode: str):
+    if mode not in WRITE_MODES:
+        raise ValueError(f"Unknown write mode: {mode}. Available: {list(WRITE_MODES)}")
+
+
+def _insert_statement(table, mode: str):
+    if mode == "insert":
+        return table.insert()
+    keys = [col.name for col in table.primary_key.columns]
+    values = [col.name for col in table.columns if col.name not in keys]
+    if mode == "ignore" or not values:
+        return table.insert().prefix_with("OR IGNORE")
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(index_elements=keys, set_={name: stmt.excluded[name] for name in values})
+
+
+def benchmark(xml_dir: str = "./api/xml_data/title1", batch_size: int = 1000):
+    """Compare ORM `add_all` against `BulkWriter` on the bundled title XML.
+
+    Files are parsed once up front so only the write path is timed. Each
+    path loads every file into its own temporary SQLite database.
+    """
+    from fetch_data import _build_rows
+    from parser import StreamingTitleXMLParser, xml_files
+
+    slug_dict = defaultdict(lambda: "unknown")
+    files = []
+    for file_path in xml_files(xml_dir):
+        issue_date = datetime.strptime(os.path.basename(file_path).rsplit("_", 1)[1][:10], "%Y-%m-%d")
+        files.append([_build_rows(item, issue_date, slug_dict) for item in StreamingTitleXMLParser(file_path)])
+    total = sum(len(rows) for rows in files)
+
+    def orm_path(engine):
+        seen = set()
+        for rows in files:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                with Session(engine) as session:
+                    for _, content, _ in batch:
+                        if content["content_hash"] not in seen:
+                            seen.add(content["content_hash"])
+                            session.add(CfrContent(**content))
+                    session.add_all([CfrText(**text) for text, _, _ in batch])
+                    session.add_all([CfrDimension(**dim) for _, _, dim in batch])
+                    session.commit()
+
+    def bulk_path(engine):
+        seen = set()
+        for rows in files:
+            with BulkWriter(engine, batch_size) as writer:
+                for text, content, dim in rows:
+                    if content["content_hash"] not in seen:
+                        seen.add(content["content_hash"])
+                        writer.add(CfrContent, content, mode="ignore")
+                    writer.add(CfrText, text)
+                    writer.add(CfrDimension, dim)
+
+    results = {}
+    for name, load in (("orm add_all", orm_path), ("bulk executemany", bulk_path)):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/bench.db")
+            create_db_and_tables(engine)
+            start = time.perf_counter()
+            load(engine)
+            elapsed = time.perf_counter() - start
+            engine.dispose()
+        results[name] = elapsed
+        print(f"{name:>18}: {total} sections in {elapsed:.2f}s ({total / elapsed:.0f} sections/s)")
+    print(f"speedup: {results['orm add_all'] / results['bulk executemany']:.1f}x")
+    return results
+
+
+def main():
+    benchmark()
+
+
+if __name__ == "__main__":
+    main()
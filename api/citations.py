@@ -0,0 +1,169 @@
+"""
+Citation extraction and the citation graph behind the "Citation depth" metric.
+
+References are parsed from section text in three forms:
+  "§ 1.2", "§§ 18.5 and 18.6"              sections of the same title
+  "part 5", "parts 9 and 20"                parts of the same title
+  "40 CFR 52.21", "36 CFR parts 1252-1258"  sections or parts of any title
+
+Citations are stored as `CfrCitation` edges and turned into a graph per
+(title, issue date) snapshot to find each section's longest citation chain.
+"""
+
+import re
+
+SECTION_NUMBER = r"\d+[a-z]?\.\d+[a-z]?(?:-\d+)?"
+PART_NUMBER = r"\d+[a-z]?"
+# separators inside a list or range of numbers: "18.5 and 18.6", "1252-1258", "9, 10, or 11"
+LIST_SEPARATOR = r"\s*(?:,\s*(?:and|or)?|and|or|through|to|-|–)\s*"
+# a paragraph designation after a section, e.g. "§ 51.5(b)(2)"
+PARAGRAPHS = r"(?:\([^()\s]{1,8}\))*"
+
+# a further number in a CFR list, but not the title of the next "N CFR M"
+CFR_ITEM = rf"(?:{SECTION_NUMBER}|{PART_NUMBER}){PARAGRAPHS}"
+CFR_RE = re.compile(rf"\b(\d+)\s+CFR\s+(?:[Pp]arts?\s+)?({CFR_ITEM}(?:{LIST_SEPARATOR}{CFR_ITEM}\b(?!\s+CFR))*)")
+SECTION_RE = re.compile(rf"§§?\s*({SECTION_NUMBER}{PARAGRAPHS}(?:{LIST_SEPARATOR}{SECTION_NUMBER}{PARAGRAPHS})*)")
+PART_RE = re.compile(rf"\b[Pp]arts?\s+({PART_NUMBER}(?:{LIST_SEPARATOR}{PART_NUMBER}\b)*)")
+RANGE_RE = re.compile(rf"(\d+)\s*(?:-|–|through|to)\s*(\d+)$")
+NUMBER_RE = re.compile(rf"{SECTION_NUMBER}|{PART_NUMBER}")
+# part ranges longer than this are kept as their two ends
+MAX_PART_RANGE = 100
+
+
+def _numbers(listed: str) -> list:
+    """Section or part numbers in a list, expanding a plain part range like "1252-1258"."""
+    numbers = NUMBER_RE.findall(re.sub(PARAGRAPHS[:-1] + "+", " ", listed))
+    span = RANGE_RE.fullmatch(listed.strip())
+    if span and "." not in listed:
+        low, high = int(span.group(1)), int(span.group(2))
+        if 0 <= high - low <= MAX_PART_RANGE:
+            return [str(number) for number in range(low, high + 1)]
+    return numbers
+
+
+def extract_citations(text: str) -> set:
+    """Return the (title, kind, number) references in `text`.
+
+    `title` is None for references within the citing section's own title;
+    `kind` is "section" or "part".
+    """
+    citations = set()
+    for match in CFR_RE.finditer(text):
+        title = int(match.group(1))
+        for number in _numbers(match.group(2)):
+            citations.add((title, "section" if "." in number else "part", number))
+    # "1 CFR part 22" must not also count as a local "part 22"
+    text = CFR_RE.sub(" ", text)
+    for match in SECTION_RE.finditer(text):
+        citations.update((None, "section", number) for number in _numbers(match.group(1)))
+    for match in PART_RE.finditer(text):
+        citations.update((None, "part", number) for number in _numbers(match.group(1)))
+    return citations
+
+
+def section_citations(title_id: int, section_id: str, citations: set) -> set:
+    """(target_title_id, target_kind, target_id) edges of one section from its `extract_citations`, without itself."""
+    return {(title or title_id, kind, number) for title, kind, number in citations
+            if (title or title_id, kind, number) != (title_id, "section", section_id)}
+
+
+def citation_depths(title_id: int, parts: dict, edges: dict) -> dict:
+    """Longest citation chain starting at each section of one snapshot.
+
+    `parts` maps every section id of the snapshot to its part; `edges` maps
+    section ids to their (target_title_id, target_kind, target_id) citations.
+    Citing a section, or a part (which leads on to each of its sections),
+    is one hop. A citation of something outside the snapshot is a chain of 1;
+    a section citing its own part ("this part") is ignored like one citing itself.
+    Sections that cite each other in a cycle are collapsed into one node
+    (strongly connected components), so a cycle cannot loop; it counts as a
+    chain of 1, so citing only each other still ranks above citing nothing.
+    Each section and edge is visited once.
+    """
+    sections = list(parts)
+    nodes = {("section", section_id): i for i, section_id in enumerate(sections)}
+    for part in sorted(set(map(str, parts.values()))):
+        nodes[("part", part)] = len(nodes)
+    # adjacency: (node, weight); reaching a part's sections from the part is free
+    adjacency = [[] for _ in nodes]
+    external = [0] * len(nodes)
+    for section_id, part in parts.items():
+        adjacency[nodes[("part", str(part))]].append((nodes[("section", section_id)], 0))
+    for section_id, targets in edges.items():
+        source = nodes.get(("section", section_id))
+        if source is None:
+            continue
+        own_part = ("part", str(parts[section_id]))
+        for target_title, kind, target_id in targets:
+            if target_title == title_id and (kind, target_id) == own_part:
+                continue
+            target = nodes.get((kind, target_id)) if target_title == title_id else None
+            if target is None:
+                external[source] = 1
+            else:
+                adjacency[source].append((target, 1))
+
+    component, count = _strongly_connected(adjacency)
+    members = [[] for _ in range(count)]
+    for node, c in enumerate(component):
+        members[c].append(node)
+    # components come out sinks first, so every component a node points to is already done
+    depth = [0] * count
+    for c in range(count):
+        for node in members[c]:
+            best = external[node]
+            for target, weight in adjacency[node]:
+                # a citation inside the cycle is still a chain of one
+                best = max(best, weight if component[target] == c else weight + depth[component[target]])
+            depth[c] = max(depth[c], best)
+    return {section_id: depth[component[nodes[("section", section_id)]]] for section_id in sections}
+
+
+def _strongly_connected(adjacency: list) -> tuple:
+    """Tarjan's algorithm without recursion; returns (component per node, component count).
+
+    Components are numbered in reverse topological order: an edge between
+    components always points to a lower number.
+    """
+    size = len(adjacency)
+    index = [-1] * size
+    low = [0] * size
+    on_stack = [False] * size
+    component = [-1] * size
+    stack = []
+    counter = 0
+    count = 0
+    for root in range(size):
+        if index[root] >= 0:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(adjacency[root]))]
+        while work:
+            node, targets = work[-1]
+            for target, _ in targets:
+                if index[target] < 0:
+                    index[target] = low[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append((target, iter(adjacency[target])))
+                    break
+                if on_stack[target]:
+                    low[node] = min(low[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        component[member] = count
+                        if member == node:
+                            break
+                    count += 1
+    return component, count
@@ -1,17 +1,28 @@
-from datetime import datetime, date
+from datetime import datetime
 from httpx import Timeout
 import asyncio
 import httpx
+import multiprocessing
 import os
+import random
+import shutil
+import sys
+import time
 from pathlib import Path
-from sqlalchemy.orm import Session
-from sqlmodel import Field, Session, SQLModel, create_engine, select, insert, delete
-from parser import TitleXMLParser
-from models import Agency, CFRReference, Title, CfrDimension, CfrMetric, CfrText,  create_db_and_tables
-from sqlalchemy import create_engine
+from queue import Empty
+from sqlmodel import Session, select, delete
+from parser import XML_SUFFIXES, TitleXMLParser, StreamingTitleXMLParser, open_xml, xml_compression, xml_files
+from bulk_writer import BulkWriter
+from metrics import TEXT_METRICS, refresh_rollups
+from models import Agency, CFRReference, Title, TitleContent, CfrContent, CfrDimension, CfrMetric, CfrText,  AGENCY_VERSION_ID, bump_data_version, create_db_and_tables, get_data_version, hash_content
+from sqlalchemy import create_engine, func, literal
 
 BASE_URL = "https://www.ecfr.gov/api"
 XML_Data_DIR = "./api/xml_data"
+# how downloaded XML is stored: "none", "gzip" or "zstd" (needs the zstandard package)
+XML_COMPRESSION = os.environ.get("ECFR_XML_COMPRESSION", "gzip")
+# downloads compress inside the event loop, so use fast levels there; `compress` rewrites at the default
+DOWNLOAD_LEVELS = {"gzip": 2, "zstd": 3}
 custom_timeout = Timeout(connect=15.0, read=120.0, write=5.0, pool=True)
 sqlite_file_name = "./api/ecfr.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
@@ -22,39 +33,94 @@ connect_args = {"check_same_thread": False}
 
 async def download_tile_xml_async(title_id: int, issue_date: datetime.date) -> bool:
     """Download XML data for a specific title and date."""
-    fmt_dt = issue_date.strftime('%Y-%m-%d')
-    dir_path = Path(f"{XML_Data_DIR}/title{title_id}")
-    dir_path.mkdir(parents=True, exist_ok=True)
-    file_path = dir_path / f"title-{title_id}_{fmt_dt}.xml"
-
-    if os.path.exists(file_path):
+    stats = await download_title_xml_bulk([(title_id, issue_date)], concurrency=1)
+    return stats["failed"] == 0
+
+
+async def download_title_xml_bulk(title_dates: list, concurrency: int = 8, retries: int = 4, backoff: float = 1.0,
+                                  base_url: str = BASE_URL) -> dict:
+    """Download many (title_id, issue_date) XML files over one pooled client.
+
+    At most `concurrency` requests run at once. Bodies are streamed to a
+    temporary file next to the target and renamed into place when complete,
+    so an interrupted download never leaves a file that looks finished.
+    Timeouts, 429s and 5xx responses are retried up to `retries` times with
+    exponential backoff (honouring Retry-After). Files that already exist
+    are skipped. Returns a summary dict (downloaded, skipped, failed, bytes, seconds).
+    """
+    title_dates = list(dict.fromkeys(title_dates))
+    stats = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=custom_timeout, limits=limits) as client:
+        results = await asyncio.gather(*(
+            _download_xml(client, semaphore, title_id, issue_date, retries, backoff, base_url)
+            for title_id, issue_date in title_dates
+        ))
+    for status, size in results:
+        stats[status] += 1
+        stats["bytes"] += size
+    stats["seconds"] = time.perf_counter() - start
+    print(f"Downloaded {stats['downloaded']} files ({stats['bytes'] / 1_000_000:.1f} MB), skipped {stats['skipped']}, "
+          f"failed {stats['failed']} in {stats['seconds']:.1f}s.")
+    return stats
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+async def _download_xml(client, semaphore, title_id: int, issue_date: datetime.date, retries: int, backoff: float,
+                        base_url: str):
+    """Download one file; returns (status, bytes) with status "downloaded", "skipped" or "failed"."""
+    file_path = _get_xml_path(title_id, issue_date)
+    if file_path.exists():
         print(f"File {file_path} already exists, skipping download.")
-        return True
-
-    url = f'{BASE_URL}/versioner/v1/full/{fmt_dt}/title-{title_id}.xml'
-
-    async with httpx.AsyncClient(timeout=custom_timeout) as client:
+        return "skipped", 0
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    url = f"{base_url}/versioner/v1/full/{issue_date:%Y-%m-%d}/title-{title_id}.xml"
+    async with semaphore:
+        for attempt in range(retries + 1):
+            tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.part")
+            retry_after = None
+            try:
+                async with client.stream("GET", url) as response:
+                    if response.status_code in RETRY_STATUS and attempt < retries:
+                        retry_after = response.headers.get("retry-after")
+                        raise httpx.HTTPStatusError(f"{response.status_code} for {url}", request=response.request,
+                                                    response=response)
+                    response.raise_for_status()
+                    size = 0
+                    compression = xml_compression(file_path)
+                    with open_xml(tmp_path, "wb", compression=compression, level=DOWNLOAD_LEVELS.get(compression)) as f:
+                        async for chunk in response.aiter_bytes(1 << 16):
+                            f.write(chunk)
+                            size += len(chunk)
+                os.replace(tmp_path, file_path)
+                print(f"Downloaded {file_path} with size {size / 1_000:.2f} KB")
+                return "downloaded", size
+            except (httpx.TimeoutException, httpx.HTTPStatusError, httpx.TransportError) as exc:
+                tmp_path.unlink(missing_ok=True)
+                retryable = not isinstance(exc, httpx.HTTPStatusError) or exc.response.status_code in RETRY_STATUS
+                if not retryable or attempt == retries:
+                    print(f"HTTP error fetching {url}: {exc}")
+                    return "failed", 0
+                delay = _retry_delay(retry_after, backoff, attempt)
+                print(f"Retrying {url} in {delay:.1f}s ({exc.__class__.__name__}, attempt {attempt + 1}/{retries})")
+                await asyncio.sleep(delay)
+            except IOError as e:
+                tmp_path.unlink(missing_ok=True)
+                print(f"Error writing to file {file_path}: {e}")
+                return "failed", 0
+
+
+def _retry_delay(retry_after, backoff: float, attempt: int) -> float:
+    if retry_after is not None:
         try:
-            print(f"Downloading {file_path} from {url}")
-            response = await client.get(url)
-            response.raise_for_status()
-
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-
-            size_kb = len(response.content) / 1_000
-            print(f"Downloaded {file_path} with size {size_kb:.2f} KB")
-            return True
-
-        except httpx.ReadTimeout as exc:
-            print(f"Read timeout: {exc}")
-            return False
-        except httpx.HTTPError as exc:
-            print(f"HTTP error fetching {url}: {exc}")
-            return False
-        except IOError as e:
-            print(f"Error writing to file {file_path}: {e}")
-            return False
+            return float(retry_after)
+        except ValueError:
+            pass
+    return backoff * 2 ** attempt + random.uniform(0, backoff)
 
 
 async def download_agencies(engine):
@@ -63,12 +129,7 @@ async def download_agencies(engine):
         response = await client.get(f"{BASE_URL}/admin/v1/agencies.json")
         response.raise_for_status()
         payload = response.json()
-        with Session(engine) as session:
-            session.exec(delete(Agency))
-            session.exec(delete(CFRReference))
-            session.commit()
-        
-        process_agencies(engine, payload["agencies"])
+        load_agencies(engine, payload["agencies"])
 
 
 async def download_titles(engine):
@@ -85,63 +146,166 @@ async def download_titles(engine):
         process_titles(engine, payload["titles"])
 
 
-def _get_agency_lookup(engine, agencies: list) -> dict:
-    """Create a lookup dictionary for agencies by slug."""
-    with Session(engine) as session:
-        created_agencies = session.exec(select(Agency)).all()
-        return {agency.slug: agency for agency in created_agencies}
+async def download_title_versions(engine, title_id: int, base_url: str = BASE_URL) -> int:
+    """Load the versioner "versions" listing of a title into `TitleContent`.
 
+    The title's previous rows are replaced. Entries whose part is not a
+    number (which `TitleContent.part` can't hold) are skipped. Returns the
+    number of rows stored.
+    """
+    async with httpx.AsyncClient(timeout=custom_timeout) as client:
+        response = await client.get(f"{base_url}/versioner/v1/versions/title-{title_id}.json")
+        response.raise_for_status()
+        payload = response.json()
 
-def _get_title_dict(engine) -> dict:
-    """Create a lookup dictionary for titles by number."""
+    versions = payload["content_versions"]
+    rows = [_title_content_row(version) for version in versions if str(version.get("part") or "").isdigit()]
+    if len(rows) < len(versions):
+        print(f"Skipped {len(versions) - len(rows)} versions without a numeric part.")
+    table = TitleContent.__table__
+    with BulkWriter(engine) as writer:
+        writer.execute(table.delete().where(table.c.title == title_id))
+        writer.add_many(TitleContent, rows, mode="ignore")
+    print(f"Loaded {len(rows)} versions for title {title_id}.")
+    return len(rows)
+
+
+def _title_content_row(version: dict) -> dict:
+    return dict(
+        amendment_date=datetime.strptime(version["amendment_date"], "%Y-%m-%d"),
+        issue_date=datetime.strptime(version["issue_date"], "%Y-%m-%d"),
+        identifier=version["identifier"],
+        name=version["name"],
+        part=int(version["part"]),
+        substantive=version["substantive"],
+        removed=version["removed"],
+        subpart=version.get("subpart"),
+        title=int(version["title"]),
+        content_type=version["type"],
+    )
+
+
+def plan_snapshots(engine, title_id: int, start_dt: datetime, end_dt: datetime) -> list:
+    """List the fewest snapshot dates that cover a title over a date range, from `TitleContent`.
+
+    That is the last issue date on or before `start_dt` (the state at the
+    start of the range) plus every issue date inside it; days without a new
+    version are left out. Each entry has `title_id`, `issue_date`, `parts`
+    (the sorted parts changed on that date), `downloaded` (the XML file
+    exists) and `ingested` (the date has text in `CfrText`).
+    """
     with Session(engine) as session:
-        return {title.number: title for title in session.exec(select(Title)).all()}
-
-
-def process_agencies(engine, data, parent=None):
+        baseline = session.exec(
+            select(func.max(TitleContent.issue_date))
+            .where(TitleContent.title == title_id, TitleContent.issue_date <= start_dt)
+        ).one()
+        changes = session.exec(
+            select(TitleContent.issue_date, TitleContent.part).distinct()
+            .where(TitleContent.title == title_id,
+                   TitleContent.issue_date >= (baseline or start_dt), TitleContent.issue_date <= end_dt)
+        ).all()
+        ingested = set(session.exec(
+            select(CfrText.issue_date).distinct().where(CfrText.title_id == title_id)
+        ).all())
+    parts = {}
+    for issue_date, part in changes:
+        parts.setdefault(issue_date, set()).add(part)
+    return [dict(title_id=title_id, issue_date=issue_date, parts=sorted(parts[issue_date]),
+                 downloaded=_get_xml_path(title_id, issue_date).exists(), ingested=issue_date in ingested)
+            for issue_date in sorted(parts)]
+
+
+async def sync_title(engine, title_id: int, start_dt: datetime, end_dt: datetime, base_url: str = BASE_URL,
+                     concurrency: int = 8) -> dict:
+    """Bring a title up to date over a date range, touching only new snapshots.
+
+    Refreshes the versions listing, plans the snapshot dates with
+    `plan_snapshots`, downloads the ones not on disk and ingests the ones
+    not in the database, oldest first. Returns the number of planned dates
+    and of snapshots actually downloaded and ingested.
+    """
+    await download_title_versions(engine, title_id, base_url)
+    plan = plan_snapshots(engine, title_id, start_dt, end_dt)
+    missing = [(title_id, snapshot["issue_date"]) for snapshot in plan if not snapshot["downloaded"]]
+    downloaded = 0
+    if missing:
+        downloaded = (await download_title_xml_bulk(missing, concurrency=concurrency, base_url=base_url))["downloaded"]
+    ingested = 0
+    for snapshot in plan:
+        # a snapshot whose download failed is skipped and picked up by the next sync
+        if not snapshot["ingested"] and process_title_xml_incremental(engine, title_id, snapshot["issue_date"]) is not None:
+            ingested += 1
+    return {"dates": len(plan), "downloaded": downloaded, "ingested": ingested}
+
+
+def flatten_agencies(data: list) -> tuple:
+    """Flatten the nested agency tree into `Agency` and `CFRReference` row dicts.
+
+    Each agency keeps its parent's slug in `parent_id`. Sibling groups come
+    out in the order the old level-by-level loader inserted them, so when two
+    agencies reference the same title:chapter the same one wins in the
+    slug index. A slug listed twice keeps its first entry.
+    """
+    agencies = {}
+    references = []
+    groups = [(data, None)]
+    while groups:
+        group, parent = groups.pop()
+        for agency_data in group:
+            slug = agency_data["slug"]
+            agencies.setdefault(slug, dict(
+                slug=slug,
+                name=agency_data["name"],
+                short_name=agency_data.get("short_name", ""),
+                display_name=agency_data["display_name"],
+                sortable_name=agency_data["sortable_name"],
+                parent_id=parent,
+            ))
+            references.extend(
+                dict(
+                    agency_slug=slug,
+                    title_id=int(item["title"]),
+                    subtitle=item.get("subtitle", ""),
+                    chapter=item.get("chapter", ""),
+                    part=item.get("part", ""),
+                    subchapter=item.get("subchapter", ""),
+                )
+                for item in agency_data.get("cfr_references", [])
+            )
+        # children of the first sibling are loaded next, as the recursion did
+        groups.extend((agency_data["children"], agency_data["slug"])
+                      for agency_data in reversed(group) if agency_data.get("children"))
+    return list(agencies.values()), references
+
+
+def load_agencies(engine, data: list, batch_size: int = 1000) -> dict:
+    """Replace `Agency` and `CFRReference` with the agencies in `data`, in one transaction.
+
+    The tree is flattened in memory and bulk-inserted with a `BulkWriter`.
+    Bumps the data and agency versions, so every process rebuilds its cached
+    `title:chapter -> agency_slug` index. Returns the new index, which is
+    also cached for `_get_slug_dict` so ingestion does not rebuild it here.
+    """
+    agencies, references = flatten_agencies(data)
+    with BulkWriter(engine, batch_size) as writer:
+        writer.execute(delete(CFRReference))
+        writer.execute(delete(Agency))
+        writer.add_many(Agency, agencies)
+        writer.add_many(CFRReference, references)
+        writer.flush()
+        if writer.failed:
+            raise RuntimeError(f"Failed to load {writer.failed} agency rows")
+        bump_data_version(writer)
+        bump_data_version(writer, AGENCY_VERSION_ID)
+    slug_dict = _slug_index(references)
+    _slug_dicts[str(engine.url)] = (get_data_version(engine, AGENCY_VERSION_ID)[0], slug_dict)
+    print(f"Loaded {len(agencies)} agencies and {len(references)} CFR references.")
+    return slug_dict
+
+
+def process_agencies(engine, data):
     """Process agencies and their CFR references, and save to the database."""
-    agencies = [
-        Agency(
-            slug=agency_data["slug"],
-            name=agency_data["name"],
-            short_name=agency_data["short_name"] if "short_name" in agency_data else "",
-            display_name=agency_data["display_name"],
-            sortable_name=agency_data["sortable_name"],
-            parent_id=parent,
-        )
-        for agency_data in data
-    ]
-    for agency in data:
-        if agency["short_name"]  == "DOI":
-            print(agency)
-            input()
-    with Session(engine) as session:
-        session.add_all(agencies)
-        session.commit()
-
-    agency_lookup = _get_agency_lookup(engine, agencies)
-    title_dict = _get_title_dict(engine)
-
-    cfr_refs = [
-        CFRReference(
-            agency_slug=agency_lookup[agency_data["slug"]].slug,
-            title_id=int(item["title"]),
-            subtitle=item.get("subtitle", ""),
-            chapter=item.get("chapter", ""),
-            part=item.get("part", ""),
-            subchapter=item.get("subchapter", ""),
-        )
-        for agency_data in data
-        for item in agency_data["cfr_references"]
-    ]
-
-    with Session(engine) as session:
-        session.add_all(cfr_refs)
-        session.commit()
-
-    for agency_data in data:
-        if agency_data.get("children"):
-            process_agencies(engine, agency_data["children"], parent=agency_lookup[agency_data["slug"]].slug)
+    return load_agencies(engine, data)
 
 
 def process_titles(engine, data):
@@ -165,81 +329,417 @@ def process_titles(engine, data):
         session.add_all(titles)
         session.commit()
 
-def process_title_xml(engine, title_id: int, issue_date: datetime.date, batch_size=1000):
-    """Process XML data for a specific title and date."""
-    # get the XML file path
+def _get_xml_path(title_id: int, issue_date: datetime.date) -> Path:
+    """Path of a title snapshot: the existing file in any compression, else where a download would go."""
     fmt_dt = issue_date.strftime('%Y-%m-%d')
-    file_path = Path(f"{XML_Data_DIR}/title{title_id}/title-{title_id}_{fmt_dt}.xml")
+    base = Path(f"{XML_Data_DIR}/title{title_id}/title-{title_id}_{fmt_dt}")
+    suffixes = [XML_SUFFIXES[XML_COMPRESSION]] + [s for s in XML_SUFFIXES.values() if s != XML_SUFFIXES[XML_COMPRESSION]]
+    for suffix in suffixes:
+        path = base.with_name(base.name + suffix)
+        if path.exists():
+            return path
+    return base.with_name(base.name + suffixes[0])
+
+
+def _snapshot_date(file_path) -> datetime:
+    return datetime.strptime(os.path.basename(file_path).rsplit("_", 1)[1][:10], "%Y-%m-%d")
+
+
+def compress_xml_cache(xml_dir: str = XML_Data_DIR, compression: str = XML_COMPRESSION) -> dict:
+    """Rewrite every cached XML snapshot under `xml_dir` in `compression`, in place.
+
+    Each file is streamed into a `.part` file next to it, renamed into place
+    and only then is the original removed, so an interrupted run leaves every
+    snapshot readable and can simply be rerun. Returns the file counts and
+    the bytes before and after.
+    """
+    if compression not in XML_SUFFIXES:
+        raise ValueError(f"Unknown compression: {compression}. Available: {list(XML_SUFFIXES)}")
+    stats = {"converted": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+    for dir_path in sorted(Path(xml_dir).glob("title*")):
+        for file_path in map(Path, xml_files(dir_path)):
+            if xml_compression(file_path) == compression:
+                stats["skipped"] += 1
+                continue
+            base = file_path.name.split(".xml", 1)[0]
+            target = file_path.with_name(base + XML_SUFFIXES[compression])
+            if not target.exists():
+                tmp_path = target.with_name(f"{target.name}.{os.getpid()}.part")
+                try:
+                    with open_xml(file_path) as src, open_xml(tmp_path, "wb", compression=compression) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                    os.replace(tmp_path, target)
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+            stats["converted"] += 1
+            stats["bytes_before"] += file_path.stat().st_size
+            stats["bytes_after"] += target.stat().st_size
+            file_path.unlink()
+    if stats["bytes_before"]:
+        print(f"Compressed {stats['converted']} files with {compression}: {stats['bytes_before'] / 1_000_000:.1f} MB -> "
+              f"{stats['bytes_after'] / 1_000_000:.1f} MB, skipped {stats['skipped']}.")
+    else:
+        print(f"Nothing to compress, skipped {stats['skipped']} files.")
+    return stats
+
+
+def _build_rows(item: dict, issue_date: datetime.date, slug_dict: dict):
+    """Build the CfrText, CfrContent and CfrDimension row dicts for one parsed section."""
+    labels, indices,  content = item["dims"], item["keys"], item["text"]
+    content_hash = hash_content(content)
+    text = dict(
+        title_id= int(indices["title"]),
+        issue_date=issue_date,
+        section_id=indices["section"],
+        content_hash=content_hash,
+    )
+    body = dict(content_hash=content_hash, content=content)
+    dim = dict(
+        title_id= int(indices["title"]),
+        issue_date=issue_date,
+        section_id=indices["section"],
+        chapter_id=indices["chapter"] if "chapter" in indices else "",
+        subchapter_id=indices["subchapter"] if "subchapter" in indices else "",
+        part_id = indices["part"] if "part" in indices else "",
+        subpart_id= indices["subpart"] if "subpart" in indices else "",
+        agency_slug=slug_dict[f"{indices['title']}:{indices['chapter']}"],
+        title=labels["title"] if "title" in labels else None,
+        chapter=labels["chapter"] if "chapter" in labels else None,
+        subchapter=None,
+        part=labels["part"] if "part" in labels else None,
+        subpart=labels["subpart"] if "subpart" in labels else None,
+        section=labels["section"],
+    )
+    return text, body, dim
+
+
+def process_title_xml(engine, title_id: int, issue_date: datetime.date, batch_size=1000, streaming=True, mode="insert"):
+    """Process XML data for a specific title and date.
+
+    `streaming` parses with `StreamingTitleXMLParser` so large titles are not
+    loaded into memory; set it to False to use the tree-based `TitleXMLParser`.
+    Rows are written by a `BulkWriter` in one transaction per file; `mode`
+    ("insert", "ignore" or "upsert") controls how duplicate rows are handled.
+    Returns the number of sections written.
+    """
+    # get the XML file path
+    file_path = _get_xml_path(title_id, issue_date)
     if not file_path.exists():
         print(f"XML file {file_path} does not exist, skipping processing.")
         return
-    items = TitleXMLParser(file_path)
+    items = StreamingTitleXMLParser(file_path) if streaming else TitleXMLParser(file_path)
     visited = _get_title_set(engine, issue_date)
-    texts = []
-    dims = []
     count = 0
     slug_dict = _get_slug_dict(engine)
-    for item in items:
-        # Process each item in the XML data
-        labels, indices,  content = item["dims"], item["keys"], item["text"]
-        key = _get_key(int(indices["title"]), issue_date, indices["section"])
-        if key in visited:
-            continue
-        visited.add(key)
-        text = CfrText(
-            title_id= int(indices["title"]),
-            issue_date=issue_date,
-            section_id=indices["section"],
-            content=content
-        )
-    
-        texts.append(text)
-        dim = CfrDimension(
-            title_id= int(indices["title"]),
-            issue_date=issue_date,
-            section_id=indices["section"],
-            chapter_id=indices["chapter"] if "chapter" in indices else "",
-            subchapter_id=indices["subchapter"] if "subchapter" in indices else "",
-            part_id = indices["part"] if "part" in indices else "",
-            subpart_id= indices["subpart"] if "subpart" in indices else "",
-            agency_slug=slug_dict[f"{indices["title"]}:{indices["chapter"]}"],
-            title=labels["title"] if "title" in labels else None,
-            chapter=labels["chapter"] if "chapter" in labels else None,
-            part=labels["part"] if "part" in labels else None,
-            subpart=labels["subpart"] if "subpart" in labels else None,
-            section=labels["section"],
-        )
-        dims.append(dim)
-        if len(texts) >= batch_size:
-            with Session(engine) as session:
-                try:
-                    session.add_all(texts)
-                    session.add_all(dims)
-                    session.commit()
-                except Exception as e:
-                    print(f"Warning: Batch insert failed (likely duplicates): {e}")
-                    session.rollback()
-            texts = []
-            dims = []
-            count += batch_size
-            print(f"Processed {count} items.")
-
-    if len(texts) > 0:
-        with Session(engine) as session:
-            try:
-                session.add_all(texts)
-                session.add_all(dims)
-                session.commit()
-            except Exception as e:
-                print(f"Warning: Final batch insert failed (likely duplicates): {e}")
-                session.rollback()
-        count += len(texts)
+    seen_bodies = set()
+    with BulkWriter(engine, batch_size, mode) as writer:
+        for item in items:
+            # Process each item in the XML data
+            key = _get_key(int(item["keys"]["title"]), issue_date, item["keys"]["section"])
+            if key in visited:
+                continue
+            visited.add(key)
+            text, body, dim = _build_rows(item, issue_date, slug_dict)
+            _add_body(writer, body, seen_bodies)
+            writer.add(CfrText, text)
+            writer.add(CfrDimension, dim)
+            count += 1
+            if count % batch_size == 0:
+                print(f"Processed {count} items.")
+        bump_data_version(writer)
+    if count % batch_size:
         print(f"Processed {count} items.")
+    return count
 
-def _get_slug_dict(engine) -> dict:
+
+def process_title_xml_incremental(engine, title_id: int, issue_date: datetime.date, batch_size=1000, mode="insert"):
+    """Ingest a snapshot as a diff against the previous ingested date of the title.
+
+    Sections are matched by section id and content hash. Only added and
+    modified sections write new bodies; unchanged sections point at the body
+    already stored and their metric values are copied forward from the
+    previous date, so `compute_metric` only has to handle the changes.
+
+    Returns a change summary with overall counts and added/modified/removed
+    counts per part, or None when the XML file is missing.
+    """
+    file_path = _get_xml_path(title_id, issue_date)
+    if not file_path.exists():
+        print(f"XML file {file_path} does not exist, skipping processing.")
+        return None
+    previous_date, previous = _get_previous_snapshot(engine, title_id, issue_date)
+    visited = _get_title_set(engine, issue_date)
+    slug_dict = _get_slug_dict(engine)
+    seen_bodies = {content_hash for content_hash, _ in previous.values()}
+    seen_sections = set()
+    summary = {"previous_date": previous_date, "unchanged": 0, "added": 0, "modified": 0, "removed": 0, "parts": {}}
+    with BulkWriter(engine, batch_size, mode) as writer:
+        for item in StreamingTitleXMLParser(file_path):
+            key = _get_key(int(item["keys"]["title"]), issue_date, item["keys"]["section"])
+            if key in visited:
+                continue
+            visited.add(key)
+            text, body, dim = _build_rows(item, issue_date, slug_dict)
+            seen_sections.add(text["section_id"])
+            old = previous.get(text["section_id"])
+            if old is None:
+                change = "added"
+            elif old[0] != text["content_hash"]:
+                change = "modified"
+            else:
+                change = "unchanged"
+            _count_change(summary, change, dim["part_id"])
+            _add_body(writer, body, seen_bodies)
+            writer.add(CfrText, text)
+            writer.add(CfrDimension, dim)
+
+        for section_id, (_, part_id) in previous.items():
+            if section_id not in seen_sections:
+                _count_change(summary, "removed", part_id)
+
+        bump_data_version(writer)
+
+        if summary["unchanged"]:
+            writer.execute(_carry_metrics_forward(title_id, previous_date, issue_date))
+            refresh_rollups(writer, title_id, issue_date)
+
+    print(f"Title {title_id} ({issue_date:%Y-%m-%d}) vs {previous_date}: {summary['added']} added, "
+          f"{summary['modified']} modified, {summary['removed']} removed, {summary['unchanged']} unchanged.")
+    return summary
+
+
+def plan_ingest(engine, title_id: int, start_dt: datetime, end_dt: datetime) -> list:
+    """List the downloaded XML snapshots of a title in the date range, oldest first.
+
+    Each entry has `title_id`, `issue_date` and `done` (the date already has
+    text in `CfrText`).
+    """
+    dir_path = Path(f"{XML_Data_DIR}/title{title_id}")
+    dates = []
+    for file_path in xml_files(dir_path):
+        issue_date = _snapshot_date(file_path)
+        if start_dt <= issue_date <= end_dt and issue_date not in dates:
+            dates.append(issue_date)
     with Session(engine) as session:
-        return {f"{cfr.title_id}:{cfr.chapter}": f"{cfr.agency_slug}" 
-                    for cfr in session.exec(select(CFRReference)).all()}
+        done = set(session.exec(
+            select(CfrText.issue_date).distinct()
+            .where(CfrText.title_id == title_id, CfrText.issue_date >= start_dt, CfrText.issue_date <= end_dt)
+        ).all())
+    return [dict(title_id=title_id, issue_date=issue_date, done=issue_date in done) for issue_date in sorted(dates)]
+
+
+def _count_change(summary: dict, change: str, part_id):
+    summary[change] += 1
+    if change == "unchanged":
+        return
+    part = summary["parts"].setdefault(str(part_id), {"added": 0, "modified": 0, "removed": 0})
+    part[change] += 1
+
+
+def _get_previous_snapshot(engine, title_id: int, issue_date: datetime.date):
+    """Return the last ingested date before `issue_date` and its {section_id: (content_hash, part_id)}."""
+    with Session(engine) as session:
+        previous_date = session.exec(
+            select(func.max(CfrText.issue_date))
+            .where(CfrText.title_id == title_id, CfrText.issue_date < issue_date)
+        ).one()
+        if previous_date is None:
+            return None, {}
+        rows = session.exec(
+            select(CfrText.section_id, CfrText.content_hash, CfrDimension.part_id)
+            .join(CfrDimension, (CfrDimension.title_id == CfrText.title_id)
+                  & (CfrDimension.issue_date == CfrText.issue_date)
+                  & (CfrDimension.section_id == CfrText.section_id), isouter=True)
+            .where(CfrText.title_id == title_id, CfrText.issue_date == previous_date)
+        ).all()
+        return previous_date, {section_id: (content_hash, part_id) for section_id, content_hash, part_id in rows}
+
+
+def _carry_metrics_forward(title_id: int, previous_date, issue_date):
+    """INSERT ... SELECT copying metric values of sections whose body did not change.
+
+    Only per-text metrics are copied; snapshot metrics such as similarity
+    depend on the other sections and are recomputed.
+    """
+    metric = CfrMetric.__table__
+    old = CfrText.__table__.alias("old")
+    new = CfrText.__table__.alias("new")
+    rows = (
+        select(metric.c.title_id, metric.c.section_id,
+               literal(issue_date, type_=metric.c.issue_date.type), metric.c.metric_id, metric.c.value)
+        .join(old, (old.c.title_id == metric.c.title_id)
+              & (old.c.section_id == metric.c.section_id)
+              & (old.c.issue_date == metric.c.issue_date))
+        .join(new, (new.c.title_id == old.c.title_id)
+              & (new.c.section_id == old.c.section_id)
+              & (new.c.content_hash == old.c.content_hash))
+        .where(metric.c.title_id == title_id, metric.c.issue_date == previous_date, new.c.issue_date == issue_date,
+               metric.c.metric_id.in_(list(TEXT_METRICS)))
+    )
+    columns = ["title_id", "section_id", "issue_date", "metric_id", "value"]
+    return metric.insert().prefix_with("OR IGNORE").from_select(columns, rows)
+
+
+def _add_body(writer, body: dict, seen: set):
+    """Queue a section body unless it was already written in this run.
+
+    Bodies are shared across dates and titles, so they are inserted with
+    INSERT OR IGNORE whatever the writer's mode is.
+    """
+    if body["content_hash"] in seen:
+        return
+    seen.add(body["content_hash"])
+    writer.add(CfrContent, body, mode="ignore")
+
+
+_file_queue = None
+_row_queue = None
+_worker_slot = None
+
+
+def _init_parse_worker(file_queue, row_queues, counter):
+    """Give each pool worker its own row queue, so the writer can read one file at a time."""
+    global _file_queue, _row_queue, _worker_slot
+    with counter.get_lock():
+        _worker_slot = counter.value
+        counter.value += 1
+    _file_queue = file_queue
+    _row_queue = row_queues[_worker_slot]
+
+
+def _parse_title_worker(args):
+    """Parse one title XML file in a pool worker, streaming rows to the writer.
+
+    The file is announced on the shared file queue; its rows, then "done" or
+    "error", follow on this worker's own bounded row queue.
+    """
+    title_id, issue_date, chunk_size = args
+    file_path = _get_xml_path(title_id, issue_date)
+    if not file_path.exists():
+        _file_queue.put(("missing", None, title_id, issue_date, str(file_path)))
+        return
+    _file_queue.put(("file", _worker_slot, title_id, issue_date, None))
+    chunk = []
+    count = 0
+    try:
+        for item in StreamingTitleXMLParser(file_path):
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                _row_queue.put(("rows", chunk))
+                count += len(chunk)
+                chunk = []
+    except Exception as e:
+        _row_queue.put(("error", str(e)))
+        return
+    if chunk:
+        _row_queue.put(("rows", chunk))
+        count += len(chunk)
+    _row_queue.put(("done", (count, file_path.stat().st_size)))
+
+
+def _get_message(queue, result):
+    """Next message from a worker queue, surfacing a pool worker that died without reporting back."""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if result.ready() and not result.successful():
+                result.get()
+
+
+def process_title_xml_bulk(engine, title_dates: list, workers: int = None, batch_size=1000, chunk_size=500, mode="insert"):
+    """Parse many (title_id, issue_date) XML files in a process pool.
+
+    Workers only parse; their rows are streamed back to this process, which
+    owns the database connection. It writes one file at a time as its rows
+    arrive and commits it on its own, so each file is one transaction and a
+    file that fails to parse partway is rolled back. Each worker has its own
+    small bounded queue, so while a file is written the others parse ahead
+    only a few chunks and memory stays flat whatever the file sizes.
+    Progress and throughput are printed as each file completes, and a summary
+    dict (files, sections, bytes, seconds) is returned.
+    """
+    title_dates = list(dict.fromkeys(title_dates))
+    workers = workers or os.cpu_count()
+    slug_dict = _get_slug_dict(engine)
+    visited = {}
+    seen_bodies = set()
+    stats = {"files": 0, "missing": 0, "errors": 0, "sections": 0, "bytes": 0, "seconds": 0.0}
+    start = time.perf_counter()
+
+    file_queue = multiprocessing.Queue()
+    row_queues = [multiprocessing.Queue(maxsize=4) for _ in range(workers)]
+    counter = multiprocessing.Value("i", 0)
+    tasks = [(title_id, issue_date, chunk_size) for title_id, issue_date in title_dates]
+    with BulkWriter(engine, batch_size, mode) as writer, \
+            multiprocessing.Pool(workers, initializer=_init_parse_worker,
+                                 initargs=(file_queue, row_queues, counter)) as pool:
+        result = pool.map_async(_parse_title_worker, tasks)
+        for finished in range(1, len(tasks) + 1):
+            kind, slot, title_id, issue_date, payload = _get_message(file_queue, result)
+            if kind == "missing":
+                stats["missing"] += 1
+                print(f"XML file {payload} does not exist, skipping processing.")
+                continue
+            seen = visited.get(issue_date)
+            if seen is None:
+                seen = visited[issue_date] = _get_title_set(engine, issue_date)
+            while True:
+                kind, payload = _get_message(row_queues[slot], result)
+                if kind != "rows":
+                    break
+                for item in payload:
+                    key = _get_key(int(item["keys"]["title"]), issue_date, item["keys"]["section"])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    text, body, dim = _build_rows(item, issue_date, slug_dict)
+                    _add_body(writer, body, seen_bodies)
+                    writer.add(CfrText, text)
+                    writer.add(CfrDimension, dim)
+            if kind == "error":
+                writer.rollback()
+                # the rolled-back keys and bodies were never written
+                visited.pop(issue_date)
+                seen_bodies.clear()
+                stats["errors"] += 1
+                print(f"Error parsing title {title_id} ({issue_date:%Y-%m-%d}): {payload}")
+                continue
+            count, size = payload
+            bump_data_version(writer)
+            writer.commit()
+            stats["files"] += 1
+            stats["sections"] += count
+            stats["bytes"] += size
+            elapsed = time.perf_counter() - start
+            print(f"[{finished}/{len(tasks)}] Title {title_id} ({issue_date:%Y-%m-%d}): {count} sections | "
+                  f"{stats['sections'] / elapsed:.0f} sections/s, {stats['bytes'] / 1_000_000 / elapsed:.2f} MB/s")
+        result.get()
+
+    stats["seconds"] = time.perf_counter() - start
+    print(f"Processed {stats['sections']} sections from {stats['files']} files in {stats['seconds']:.1f}s.")
+    return stats
+
+
+# (agency version, title:chapter -> agency_slug) per database, built by load_agencies or on
+# first use and rebuilt once the agency version moves on, i.e. after another process reloads agencies
+_slug_dicts = {}
+
+
+def _slug_index(references) -> dict:
+    return {f"{cfr['title_id']}:{cfr['chapter']}": f"{cfr['agency_slug']}" for cfr in references}
+
+
+def _get_slug_dict(engine) -> dict:
+    key = str(engine.url)
+    version, _ = get_data_version(engine, AGENCY_VERSION_ID)
+    entry = _slug_dicts.get(key)
+    if entry is None or entry[0] != version:
+        with Session(engine) as session:
+            references = session.exec(select(CFRReference).order_by(CFRReference.id)).all()
+            entry = _slug_dicts[key] = (version, _slug_index(cfr.model_dump() for cfr in references))
+    return entry[1]
  
 def _get_key(title_id, issue_date, section_id):
     return f"{title_id}:{issue_date}:{section_id}"
@@ -274,4 +774,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["compress"]:
+        compress_xml_cache(compression=sys.argv[2] if len(sys.argv) > 2 else XML_COMPRESSION)
+    else:
+        main()
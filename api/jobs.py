@@ -0,0 +1,202 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fetch_data import plan_ingest, process_title_xml_incremental
+from metrics import compute_shards, plan_compute
+
+JOB_KINDS = ("compute", "ingest")
+ACTIVE_STATES = ("queued", "running")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """One background ingestion or metric computation over a title and date range.
+
+    The work is a list of (title_id, issue_date) units, planned when the job
+    starts running. Progress is counted per unit and per section so rates and
+    an ETA can be reported while it runs.
+    """
+    def __init__(self, job_id: str, kind: str, title_id: int, start_dt: datetime, end_dt: datetime, workers: int = 1):
+        self.id = job_id
+        self.kind = kind
+        self.title_id = title_id
+        self.start_dt = start_dt
+        self.end_dt = end_dt
+        self.workers = workers
+        self.status = "queued"
+        self.error = None
+        self.overlaps = []
+        self.dates_total = 0
+        self.dates_done = 0
+        self.dates_skipped = 0
+        self.sections_total = 0
+        self.sections_done = 0
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._sections = {}
+        self._cancel = threading.Event()
+        self._started = None
+
+    def overlaps_with(self, other) -> bool:
+        return (self.kind == other.kind and self.title_id == other.title_id
+                and self.start_dt <= other.end_dt and other.start_dt <= self.end_dt)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == "queued":
+            self.status = "cancelled"
+            self.finished_at = datetime.now()
+
+    def start(self):
+        self.status = "running"
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+
+    def plan(self, units: dict):
+        """Record the pending units, a dict of {(title_id, issue_date): sections}."""
+        self._sections = units
+        self.dates_total = len(units)
+        self.sections_total = sum(units.values())
+
+    def advance(self, title_id: int, issue_date: datetime, sections: int = None):
+        """Mark one unit finished; raises `JobCancelled` once cancellation was requested."""
+        self.dates_done += 1
+        self.sections_done += self._sections.get((title_id, issue_date), 0) if sections is None else sections
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} cancelled")
+
+    def to_dict(self) -> dict:
+        elapsed = None
+        rate = None
+        eta = None
+        if self._started is not None:
+            elapsed = (self.finished_at.timestamp() - self.started_at.timestamp()
+                       if self.finished_at else time.perf_counter() - self._started)
+            if elapsed > 0:
+                rate = self.sections_done / elapsed
+            # ingestion only learns section counts as files are parsed, so it estimates by dates
+            if self.kind == "compute" and self.sections_total:
+                fraction = self.sections_done / self.sections_total
+            else:
+                fraction = self.dates_done / self.dates_total if self.dates_total else 0
+            if self.status == "running" and fraction > 0:
+                eta = elapsed * (1 - fraction) / fraction
+        return {
+            "id": self.id, "kind": self.kind, "status": self.status, "error": self.error,
+            "title_id": self.title_id, "start_dt": self.start_dt.isoformat(), "end_dt": self.end_dt.isoformat(),
+            "workers": self.workers, "overlaps": self.overlaps,
+            "dates_total": self.dates_total, "dates_done": self.dates_done, "dates_skipped": self.dates_skipped,
+            "sections_total": self.sections_total, "sections_done": self.sections_done,
+            "sections_per_s": round(rate, 1) if rate is not None else None,
+            "elapsed_s": round(elapsed, 1) if elapsed is not None else None,
+            "eta_s": round(eta, 1) if eta is not None else None,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class JobManager:
+    """Run jobs one at a time on a single writer thread, in submission order.
+
+    Running jobs serially is also how overlapping requests are deduplicated:
+    a job plans its units only when it starts, after every earlier job has
+    finished, so dates an earlier job completed (`MetricShard` for metrics,
+    existing `CfrText` for ingestion) are skipped rather than recomputed.
+    A job submitted while an identical one is still queued or running gets
+    that job back instead of a new one.
+    """
+    def __init__(self, engine, executor: ThreadPoolExecutor = None, max_finished: int = 100):
+        self.engine = engine
+        self.executor = executor or ThreadPoolExecutor(1, thread_name_prefix="ecfr-jobs")
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, title_id: int, start_dt: datetime, end_dt: datetime, workers: int = 1) -> Job:
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}. Available: {list(JOB_KINDS)}")
+        with self._lock:
+            active = [job for job in self._jobs.values() if job.status in ACTIVE_STATES]
+            for job in active:
+                if (job.kind, job.title_id, job.start_dt, job.end_dt) == (kind, title_id, start_dt, end_dt):
+                    return job
+            job = Job(str(next(self._ids)), kind, title_id, start_dt, end_dt, workers)
+            job.overlaps = [other.id for other in active if job.overlaps_with(other)]
+            self._jobs[job.id] = job
+            self._prune()
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        return self._jobs.get(job_id)
+
+    def all(self) -> list:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Job:
+        """Request cancellation; a running job stops after its current date."""
+        job = self._jobs.get(job_id)
+        if job is not None and job.status in ACTIVE_STATES:
+            job.cancel()
+        return job
+
+    def _run(self, job: Job):
+        if job.cancelled:
+            return
+        job.start()
+        try:
+            if job.kind == "compute":
+                self._run_compute(job)
+            else:
+                self._run_ingest(job)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.now()
+
+    def _run_compute(self, job: Job):
+        plan = plan_compute(self.engine, [job.title_id], job.start_dt, job.end_dt)
+        pending = [shard for shard in plan if not shard["done"]]
+        job.dates_skipped = len(plan) - len(pending)
+        job.plan({(shard["title_id"], shard["issue_date"]): shard["sections"] for shard in pending})
+        job.check_cancelled()
+        shards = [(shard["title_id"], shard["issue_date"]) for shard in pending]
+        compute_shards(self.engine, shards, workers=job.workers,
+                       progress=lambda title_id, issue_date, rows: job.advance(title_id, issue_date))
+
+    def _run_ingest(self, job: Job):
+        plan = plan_ingest(self.engine, job.title_id, job.start_dt, job.end_dt)
+        pending = [unit for unit in plan if not unit["done"]]
+        job.dates_skipped = len(plan) - len(pending)
+        # section counts are only known once a file is parsed
+        job.plan({(unit["title_id"], unit["issue_date"]): 0 for unit in pending})
+        for unit in pending:
+            job.check_cancelled()
+            summary = process_title_xml_incremental(self.engine, unit["title_id"], unit["issue_date"])
+            sections = summary["added"] + summary["modified"] + summary["unchanged"] if summary else 0
+            job.sections_total += sections
+            job.advance(unit["title_id"], unit["issue_date"], sections)
+
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if job.status not in ACTIVE_STATES]
+        for job in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job.id]
@@ -1,49 +1,132 @@
 from datetime import datetime
-from typing import List, Callable, Dict, Any
-from sqlmodel import Session, select, text
+from functools import partial
+from typing import List, Callable, Dict, Any, Tuple
+from sqlmodel import Session, create_engine, func, select
+from sqlalchemy import String, and_, cast, column, delete, literal, or_, table
 from models import (
+    CfrCitation,
+    CfrContent,
+    CfrContentMetric,
     CfrMetric,
     CfrText,
+    MetricRollup,
+    MetricShard,
     Agency,
-    Title,
-    CFRReference,
     CfrDimension,
-    TitleContent,
+    bump_data_version,
     create_db_and_tables,
 )
+from bulk_writer import BulkWriter
+from citations import citation_depths, extract_citations, section_citations
 import pandas as pd
+import base64
 import json
+import multiprocessing
+import re
+import sys
+import time
 
-def compute_word_count(text: str) -> int:
-    words = text.split()
-    return len(words)
+class TextAnalysis:
+    """One section text, tokenized once and shared by every metric.
 
-def keyword_count(text: str) -> int:    
-    return text.count('the')
+    Words are split once; the unique word set, substring counts and
+    citations are computed on first use and cached, so metrics that need the
+    same pass (e.g. two metrics counting '.') only pay for it once.
+    """
+    __slots__ = ("text", "words", "_unique_words", "_counts", "_citations")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.words = text.split()
+        self._unique_words = None
+        self._counts = {}
+        self._citations = None
+
+    @property
+    def word_count(self) -> int:
+        return len(self.words)
+
+    @property
+    def unique_words(self) -> set:
+        if self._unique_words is None:
+            self._unique_words = set(self.words)
+        return self._unique_words
+
+    @property
+    def citations(self) -> set:
+        """(title, kind, number) references in the text, see `citations.extract_citations`."""
+        if self._citations is None:
+            self._citations = extract_citations(self.text)
+        return self._citations
+
+    def count(self, pattern: str) -> int:
+        """Non-overlapping occurrences of `pattern`, like `str.count`."""
+        if pattern not in self._counts:
+            self._counts[pattern] = self.text.count(pattern)
+        return self._counts[pattern]
+
+
+def compute_word_count(doc: TextAnalysis) -> int:
+    return doc.word_count
 
-def cross_reference_count(text: str) -> int:
-    return text.count('.')
+def keyword_count(doc: TextAnalysis) -> int:    
+    return doc.count('the')
 
-def diversity(text: str) -> int:
-    words = text.split()
-    unique_words = set(words)
-    return len(unique_words)
+def cross_reference_count(doc: TextAnalysis) -> int:
+    return len(doc.citations)
 
-def citation_depth(text: str) -> int:
-    return text.count('.')
+def diversity(doc: TextAnalysis) -> int:
+    return len(doc.unique_words)
 
+def term_count(term: str, doc: TextAnalysis) -> int:
+    return doc.count(term)
 
+
+# Metric functions take a TextAnalysis; append new ones at the end so ids stay stable.
+# A metric without a function depends on the other sections of its (title, date)
+# and is computed per shard from the citation graph (see `_shard_citations`).
 METRICS = [
     ("Word count", compute_word_count),
     ("Keyword count", keyword_count),
     ("cross-references Average", cross_reference_count),
     ("Lexical diversity", diversity),
-    ("Citation depth", citation_depth),
+    ("Citation depth", None),
 ]
 
+# Literal terms counted in every section, one metric each named "Term: <term>".
+# Counts are exactly `str.count` (case-sensitive, non-overlapping). Term metrics
+# take ids from 200 in list order, so only append to TERMS.
+TERMS = ["shall", "must", "prohibited", "§", "CFR", "U.S.C."]
+TERM_METRIC_BASE = 200
+
+# Per-text metrics by id: METRICS by position, then the term metrics. Values are
+# cached per body in CfrContentMetric, so each term costs one scan per unique text.
+TEXT_METRICS: Dict[int, Tuple[str, Callable[[TextAnalysis], Any]]] = {
+    idx: metric for idx, metric in enumerate(METRICS) if metric[1] is not None}
+TEXT_METRICS.update({TERM_METRIC_BASE + idx: (f"Term: {term}", partial(term_count, term))
+                     for idx, term in enumerate(TERMS)})
+
+# Metrics computed across a whole snapshot rather than per text (see similarity.py).
+# Their ids are 100-199.
+SNAPSHOT_METRICS: Dict[str, int] = {"Lexical similarity": 100}
+
+CITATION_DEPTH_ID = 4
+# A shard (title, date) is complete once it has this many metrics: every text metric plus citation depth.
+SHARD_METRIC_COUNT = len(TEXT_METRICS) + 1
+
 # Helper maps for name <-> id lookup
-METRICS_MAP: Dict[str, int] = {name: idx for idx, (name, _) in enumerate(METRICS)}
-METRICS_FUNCS: Dict[str, Callable[[str], Any]] = {name: func for name, func in METRICS}
+METRICS_MAP: Dict[str, int] = {name: idx for idx, (name, _) in TEXT_METRICS.items()}
+METRICS_MAP[METRICS[CITATION_DEPTH_ID][0]] = CITATION_DEPTH_ID
+METRICS_MAP.update(SNAPSHOT_METRICS)
+METRICS_FUNCS: Dict[str, Callable[[TextAnalysis], Any]] = {name: func for name, func in TEXT_METRICS.values()}
+
+
+def compute_all(text: str, metric_ids=None) -> Dict[int, Any]:
+    """Analyze `text` once and return {metric_id: value} for the requested per-text metrics (default all)."""
+    doc = TextAnalysis(text)
+    if metric_ids is None:
+        metric_ids = TEXT_METRICS
+    return {metric_id: TEXT_METRICS[metric_id][1](doc) for metric_id in metric_ids}
 
 
 
@@ -52,108 +135,572 @@ sqlite_file_name = "./api/ecfr.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 LEVEL_NAMES = ["Title", "Chapter", "Subchapter", "Part", "Subpart", "Section"]
+LEVEL_COLUMNS = [CfrDimension.title, CfrDimension.chapter, CfrDimension.subchapter, CfrDimension.part, CfrDimension.subpart, CfrDimension.section]
+# levels below this are served from MetricRollup; sections are read from CfrMetric directly
+ROLLUP_LEVELS = 5
+TABLE_HEADERS = ["agency_slug", "Title", "Level_Name", "Level", "Date", "Value"]
+# result columns of `_table_query`
+TABLE_COLUMNS = ["agency_slug", "title", "level_value", "issue_date", "value"]
+# the FTS5 index kept by models.create_keyword_index, and CfrContent's rowid it points at
+KEYWORD_VOCAB = table("cfrcontent_vocab", column("term"), column("doc"), column("col"), column("offset"))
+KEYWORD_CONTENT = table("cfrcontent", column("rowid"), column("content_hash"))
+KEYWORD_TOKEN_RE = re.compile(r"[^\W_]+")
+# sort fields for paged table queries; after the first, in group-key order for tie-breaking
+ORDER_FIELDS = ("value", "agency", "title", "level", "date")
 
 def getTable(engine, metric_id:int, agencies:List[str], level:int, start_dt:datetime, end_st:datetime):
     """Return raw rows from the DB for the given metric id.
 
-    This function expects an integer `metric_id` (index into METRICS).
+    This function expects an integer `metric_id` (see METRICS_MAP).
     Use `gettable` for JSON-serializable responses that accept metric names.
     
     Args:
         engine: SQLModel engine
-        metric_id: index into METRICS list
+        metric_id: metric id, a value of METRICS_MAP
         agencies: list of agency short names to filter by
         level: dimension level (0=title, 1=chapter, 2=subchapter, 3=part, 4=subpart, 5=section)
-        start_dt: start datetime
-        end_st: end datetime
+        start_dt: start datetime (inclusive, None for no lower bound)
+        end_st: end datetime (inclusive, None for no upper bound)
     """
+    query = _table_query(engine, metric_id, agencies, level, start_dt, end_st)
+    with Session(engine) as session:
+        return session.exec(query).all()
+
+
+def _table_query(engine, metric_id: int, agencies: List[str], level: int, start_dt: datetime, end_st: datetime):
+    """Build the getTable select: (agency_slug, title, level value, issue_date, value) per group."""
+    agency_slugs = _agency_slugs(engine, agencies)
+    level_col = LEVEL_COLUMNS[level]
+    if level < ROLLUP_LEVELS:
+        return _rollup_query(metric_id, agency_slugs, level, start_dt, end_st)
+    query = (
+        select(CfrDimension.agency_slug, CfrDimension.title.label("title"), level_col.label("level_value"),
+               CfrMetric.issue_date, func.sum(CfrMetric.value).label("value"))
+        .join(CfrDimension, (CfrDimension.title_id == CfrMetric.title_id)
+              & (CfrDimension.issue_date == CfrMetric.issue_date)
+              & (CfrDimension.section_id == CfrMetric.section_id))
+        .where(CfrMetric.metric_id == metric_id, CfrDimension.agency_slug.in_(agency_slugs))
+        .group_by(CfrDimension.agency_slug, CfrDimension.title, level_col, CfrMetric.issue_date)
+    )
+    return _where_dates(query, CfrMetric.issue_date, start_dt, end_st)
+
+
+def _agency_slugs(engine, agencies: List[str]) -> List[str]:
+    """Map agency short names to slugs, raising ValueError for unknown names."""
     agency_dict = _get_agency_dict(engine)
-    Levels =[ CfrDimension.title,  CfrDimension.chapter,  CfrDimension.subchapter,  CfrDimension.part,  CfrDimension.subpart, CfrDimension.section]
-    level_col = Levels[level]
-    # Safely build agency slug list from known agencies
     try:
-        agency_slugs = [agency_dict[short_name].slug for short_name in agencies]
+        return [agency_dict[short_name].slug for short_name in agencies]
     except KeyError as e:
         raise ValueError(f"Unknown agency: {e}. Available: {list(agency_dict.keys())}")
-    agencies_set = ",".join([f"'{slug}'" for slug in agency_slugs])
-    query = text(f"select cfrDimension.agency_slug, cfrDimension.title, {level_col},  cfrMetric.issue_date, sum(cfrmetric.value)  from cfrdimension, cfrmetric "
-                    f"where  CfrMetric.metric_id == {metric_id} "
-                    f"and cfrdimension.agency_slug in ({agencies_set}) "
-                    "and cfrDimension.title_id == cfrMetric.title_id "
-                    "and cfrDimension.issue_date == cfrMetric.issue_date "
-                    "and cfrDimension.section_id == cfrMetric.section_id "
-                    f"group by  cfrDimension.agency_slug, cfrDimension.title,  {level_col}, cfrMetric.issue_date")
-    
-    rows = []
+
+
+def keyword_tokens(phrase: str) -> List[str]:
+    """Split a term or phrase into lowercase tokens the way the FTS5 unicode61 tokenizer does."""
+    return KEYWORD_TOKEN_RE.findall(phrase.lower())
+
+
+def _keyword_hits(tokens: List[str]):
+    """(content_hash, hits) of the bodies containing the phrase, counted from the index's term positions.
+
+    A phrase matches where each token sits at the next offset after the
+    previous one; every token's occurrences are materialized once so the
+    offsets are joined through automatic indexes.
+    """
+    occurrences = [
+        select(KEYWORD_VOCAB.c.doc, KEYWORD_VOCAB.c.col, KEYWORD_VOCAB.c.offset)
+        .where(KEYWORD_VOCAB.c.term == token).cte(f"token{i}").prefix_with("MATERIALIZED")
+        for i, token in enumerate(tokens)
+    ]
+    first = occurrences[0]
+    counts = select(first.c.doc, func.count().label("hits")).select_from(first)
+    for i, token in enumerate(occurrences[1:], 1):
+        counts = counts.join(token, (token.c.doc == first.c.doc) & (token.c.col == first.c.col)
+                             & (token.c.offset == first.c.offset + i))
+    counts = counts.group_by(first.c.doc).subquery()
+    return (select(KEYWORD_CONTENT.c.content_hash, counts.c.hits)
+            .join(counts, KEYWORD_CONTENT.c.rowid == counts.c.doc)
+            .cte("hits").prefix_with("MATERIALIZED"))
+
+
+def _keyword_query(agency_slugs: List[str], phrase: str, level: int, start_dt: datetime, end_dt: datetime):
+    """Build the keyword select: (agency_slug, title, level value, issue_date, hits) per group."""
+    tokens = keyword_tokens(phrase)
+    if not tokens:
+        raise ValueError(f"No searchable words in term: {phrase!r}")
+    hits = _keyword_hits(tokens)
+    level_col = LEVEL_COLUMNS[level]
+    query = (
+        select(CfrDimension.agency_slug, CfrDimension.title.label("title"), level_col.label("level_value"),
+               CfrText.issue_date, func.sum(hits.c.hits).label("value"))
+        .select_from(hits)
+        .join(CfrText, CfrText.content_hash == hits.c.content_hash)
+        .join(CfrDimension, (CfrDimension.title_id == CfrText.title_id)
+              & (CfrDimension.issue_date == CfrText.issue_date)
+              & (CfrDimension.section_id == CfrText.section_id))
+        .where(CfrDimension.agency_slug.in_(agency_slugs))
+        .group_by(CfrDimension.agency_slug, CfrDimension.title, level_col, CfrText.issue_date)
+        .order_by(CfrDimension.agency_slug, CfrDimension.title, level_col, CfrText.issue_date)
+    )
+    return _where_dates(query, CfrText.issue_date, start_dt, end_dt)
+
+
+def keyword_table(engine, terms: List[str], agencies: List[str], level: int, start_dt: datetime, end_dt: datetime) -> list:
+    """Count whole-word hits of each term or phrase, grouped like `gettable`, from the FTS5 index.
+
+    Matching is case-insensitive on whole tokens, so "shall" does not count
+    "marshall" as `str.count` would. Only bodies containing the term are
+    read. Returns a list of dicts with the `TABLE_HEADERS` keys plus "Term";
+    groups without a hit are left out.
+    """
+    agency_slugs = _agency_slugs(engine, agencies)
+    queries = [(term, _keyword_query(agency_slugs, term, level, start_dt, end_dt)) for term in terms]
+    return [dict(Term=term, **dict(zip(TABLE_HEADERS, row)))
+            for term, query in queries
+            for chunk in _iter_chunks(engine, query, LEVEL_NAMES[level], 5000)
+            for row in chunk]
+
+
+def _where_dates(query, column, start_dt: datetime, end_dt: datetime):
+    """Restrict `query` to start_dt <= column <= end_dt; either bound may be None."""
+    if start_dt is not None:
+        query = query.where(column >= start_dt)
+    if end_dt is not None:
+        query = query.where(column <= end_dt)
+    return query
+
+
+def _page_query(query, order_by: str = None, limit: int = None, after: str = None, top_n: int = None):
+    """Wrap a table query with top-N per date, ordering, keyset pagination and a limit, all in SQL.
+
+    `top_n` keeps the N largest values of each issue date. `order_by` is one
+    of ORDER_FIELDS, "-" prefixed for descending; ties are broken by the
+    group key so the order is total. `after` is a cursor from `table_cursor`
+    and resumes right after the row it was made from.
+    """
+    if top_n is not None:
+        sub = query.subquery()
+        rank = func.row_number().over(
+            partition_by=sub.c.issue_date,
+            order_by=[sub.c.value.desc()] + [expr for expr, _ in _order_keys(sub, "agency")]).label("rank")
+        ranked = select(sub, rank).subquery()
+        query = select(*(ranked.c[name] for name in TABLE_COLUMNS)).where(ranked.c.rank <= top_n)
+    if order_by is None and limit is None and after is None:
+        return query
+    order_by = order_by or "agency"
+    sub = query.subquery()
+    keys = _order_keys(sub, order_by)
+    query = select(*(sub.c[name] for name in TABLE_COLUMNS))
+    if after is not None:
+        query = query.where(_after_key(keys, _decode_cursor(after, order_by)))
+    query = query.order_by(*(expr.desc() if descending else expr for expr, descending in keys))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def _order_keys(sub, order_by: str) -> list:
+    """(expression, descending) pairs: the requested field, then the rest of the group key."""
+    descending = order_by.startswith("-")
+    field = order_by.lstrip("-")
+    if field not in ORDER_FIELDS:
+        raise ValueError(f"Unknown order_by: {order_by}. Available: {list(ORDER_FIELDS)} (prefix '-' for descending)")
+    columns = {
+        "value": sub.c.value,
+        "date": sub.c.issue_date,
+        "agency": sub.c.agency_slug,
+        "title": func.coalesce(sub.c.title, ""),
+        "level": func.coalesce(cast(sub.c.level_value, String), ""),
+    }
+    return [(columns[field], descending)] + [(columns[name], False) for name in ORDER_FIELDS[1:] if name != field]
+
+
+def _after_key(keys: list, values: list):
+    """Row-value "comes after" condition for mixed sort directions."""
+    clauses = []
+    for i, (expr, descending) in enumerate(keys):
+        equal = [keys[j][0] == values[j] for j in range(i)]
+        clauses.append(and_(*equal, expr < values[i] if descending else expr > values[i]))
+    return or_(*clauses)
+
+
+def table_cursor(row: dict, order_by: str = None) -> str:
+    """Opaque keyset cursor for a `gettable` row, to pass back as `after`."""
+    order_by = order_by or "agency"
+    field = order_by.lstrip("-")
+    values = {"value": row["Value"], "date": row["Date"], "agency": row["agency_slug"],
+              "title": row["Title"] or "", "level": "" if row["Level"] is None else str(row["Level"])}
+    key = [values[field]] + [values[name] for name in ORDER_FIELDS[1:] if name != field]
+    payload = json.dumps({"order_by": order_by, "key": key})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor: str, order_by: str) -> list:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        key = payload["key"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if payload.get("order_by") != order_by:
+        raise ValueError(f"Cursor was made for order_by={payload.get('order_by')}, not {order_by}")
+    field = order_by.lstrip("-")
+    names = [field] + [name for name in ORDER_FIELDS[1:] if name != field]
+    return [datetime.fromisoformat(value) if name == "date" else value for name, value in zip(names, key)]
+
+
+def _rollup_query(metric_id: int, agency_slugs: List[str], level: int, start_dt: datetime, end_dt: datetime):
+    query = (
+        select(MetricRollup.agency_slug, func.nullif(MetricRollup.title, "").label("title"),
+               func.nullif(MetricRollup.level_value, "").label("level_value"),
+               MetricRollup.issue_date, func.sum(MetricRollup.value).label("value"))
+        .where(MetricRollup.level == level, MetricRollup.metric_id == metric_id,
+               MetricRollup.agency_slug.in_(agency_slugs))
+        .group_by(MetricRollup.agency_slug, MetricRollup.title, MetricRollup.level_value, MetricRollup.issue_date)
+    )
+    return _where_dates(query, MetricRollup.issue_date, start_dt, end_dt)
+
+
+def refresh_rollups(writer, title_id: int, issue_date: datetime):
+    """Rebuild the `MetricRollup` rows of one (title, date) from its `CfrMetric` values.
+
+    Runs on the writer's connection, so the rollups commit together with the
+    metric rows they summarize. Bumps the data version for the API caches.
+    """
+    rollup = MetricRollup.__table__
+    metric = CfrMetric.__table__
+    dim = CfrDimension.__table__
+    writer.execute(rollup.delete().where(rollup.c.title_id == title_id, rollup.c.issue_date == issue_date))
+    columns = ["level", "metric_id", "agency_slug", "issue_date", "title_id", "title", "level_value", "value"]
+    for level in range(ROLLUP_LEVELS):
+        level_col = dim.c[LEVEL_COLUMNS[level].key]
+        title_label = func.coalesce(dim.c.title, "")
+        level_value = func.coalesce(cast(level_col, String), "")
+        rows = (
+            select(literal(level), metric.c.metric_id, dim.c.agency_slug, metric.c.issue_date, metric.c.title_id,
+                   title_label, level_value, func.sum(metric.c.value))
+            .join(dim, (dim.c.title_id == metric.c.title_id)
+                  & (dim.c.issue_date == metric.c.issue_date)
+                  & (dim.c.section_id == metric.c.section_id))
+            .where(metric.c.title_id == title_id, metric.c.issue_date == issue_date)
+            .group_by(metric.c.metric_id, dim.c.agency_slug, title_label, level_value)
+        )
+        writer.execute(rollup.insert().from_select(columns, rows))
+    bump_data_version(writer)
+
+
+def rebuild_rollups(engine, batch_size = 10000):
+    """Rebuild `MetricRollup` for every (title, date) that has metric values, e.g. after an upgrade."""
     with Session(engine) as session:
-        items = session.exec(query)
-        for item in items:
-            rows.append(item)
-       
-    return rows    
+        shards = session.exec(select(CfrMetric.title_id, CfrMetric.issue_date).distinct()).all()
+    with BulkWriter(engine, batch_size) as writer:
+        for title_id, issue_date in shards:
+            refresh_rollups(writer, title_id, issue_date)
+    return len(shards)
+
 
+def reset_metrics(engine, metric_names: List[str]):
+    """Delete every stored value of the named metrics so the next run recomputes them.
 
-def gettable(engine, metric_name: str, agencies:List[str], level:int, start_dt:datetime, end_st:datetime):
+    Use after a metric's definition changes. The per-body cache and rollups
+    go too, and every `MetricShard` marker is cleared so `compute_metric_parallel`
+    revisits all shards; metrics that are still present are skipped per row.
+    """
+    unknown = [name for name in metric_names if name not in METRICS_MAP]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {unknown}. Available: {list(METRICS_MAP)}")
+    metric_ids = [METRICS_MAP[name] for name in metric_names]
+    with BulkWriter(engine) as writer:
+        for model in (CfrMetric, CfrContentMetric, MetricRollup):
+            writer.execute(delete(model).where(model.metric_id.in_(metric_ids)))
+        writer.execute(delete(MetricShard))
+        if CITATION_DEPTH_ID in metric_ids:
+            writer.execute(delete(CfrCitation))
+        bump_data_version(writer)
+    print(f"Reset {metric_names}; rerun the metric computation to fill them again.")
+
+
+def gettable(engine, metric_name: str, agencies:List[str], level:int, start_dt:datetime, end_st:datetime, **page):
     """Return JSON-serializable list-of-dicts for a table query.
 
     Matches the HTML table produced by `get_metric_table` in `app.py` but
     returns structured data suitable for API/JSON responses or page queries.
+    `page` takes the `order_by`, `limit`, `after` and `top_n` options of `iter_table`.
+    """
+    return [dict(zip(TABLE_HEADERS, row))
+            for chunk in iter_table(engine, metric_name, agencies, level, start_dt, end_st, **page)
+            for row in chunk]
+
+
+def iter_table(engine, metric_name: str, agencies: List[str], level: int, start_dt: datetime, end_st: datetime,
+               chunk_size: int = 5000, order_by: str = None, limit: int = None, after: str = None, top_n: int = None):
+    """Yield the rows of a table query in lists of up to `chunk_size`, without loading the whole result.
+
+    Rows are tuples in `TABLE_HEADERS` order with ISO dates. `order_by`,
+    `limit`, `after` and `top_n` are applied in SQL (see `_page_query`).
+    Unknown metric or agency names raise ValueError here, before the first
+    chunk is read.
     """
-    # Map metric name to id
     metric_id = METRICS_MAP.get(metric_name)
     if metric_id is None:
         raise ValueError(f"Unknown metric name: {metric_name}")
-    rows = getTable(engine, metric_id, agencies, level, start_dt, end_st)
-    headers = ["agency_slug", "Title", "Level_Name", "Level", "Date", "Value"]
-    list_of_dicts = []
-    for row in rows:
-        row = list(row)
-        # Insert level name before the level value
-        row.insert(2, LEVEL_NAMES[level])
-        # Normalize datetime to ISO format for JSON
-        if isinstance(row[4], datetime):
-            row[4] = row[4].isoformat()
-        list_of_dicts.append(dict(zip(headers, row)))
-    return list_of_dicts
+    query = _table_query(engine, metric_id, agencies, level, start_dt, end_st)
+    query = _page_query(query, order_by, limit, after, top_n)
+    return _iter_chunks(engine, query, LEVEL_NAMES[level], chunk_size)
+
+
+def _iter_chunks(engine, query, level_name: str, chunk_size: int):
+    with engine.connect() as conn:
+        for partition in conn.execute(query).partitions(chunk_size):
+            yield [(agency_slug, title, level_name, level_value,
+                    issue_date.isoformat() if isinstance(issue_date, datetime) else issue_date, value)
+                   for agency_slug, title, level_value, issue_date, value in partition]
 
     
-def compute_metric(engine, title_id: int, start_dt: datetime, end_dt: datetime, batch_size = 10000):
-    metrics = []
+def compute_metric(engine, title_id: int, start_dt: datetime, end_dt: datetime, batch_size = 10000, mode = "insert", progress = None) -> dict:
+    """Compute every metric for the title's sections over the date range.
+
+    Only issue dates that actually have text for the title are visited (see
+    `plan_compute`). Metric functions run once per unique section body:
+    values are cached in `CfrContentMetric` by content hash and reused for
+    every date (and title) that shares the text. Values are written as plain
+    rows through a `BulkWriter`; `mode` is passed through to it ("insert",
+    "ignore" or "upsert"). See `compute_shards` for `progress`.
+    """
+    shards = [(shard["title_id"], shard["issue_date"]) for shard in plan_compute(engine, [title_id], start_dt, end_dt)]
+    return compute_shards(engine, shards, workers=1, batch_size=batch_size, mode=mode, progress=progress)
+
+
+def _fill_content_metrics(session, hashes: set, cache: dict, citations: dict = None, chunk_size = 500) -> list:
+    """Make sure `cache` holds every metric value for each content hash.
+
+    Values already stored in `CfrContentMetric` are loaded; bodies that are
+    missing some metric are fetched and computed. Citations extracted along
+    the way are kept in `citations` by hash for `_shard_citations`. Returns
+    the newly computed `CfrContentMetric` rows for the caller to write.
+    """
+    new_rows = []
+    missing = [h for h in hashes if h not in cache]
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        for row in session.exec(select(CfrContentMetric).where(CfrContentMetric.content_hash.in_(chunk),
+                                                               CfrContentMetric.metric_id.in_(list(TEXT_METRICS)))):
+            cache.setdefault(row.content_hash, {})[row.metric_id] = row.value
+    incomplete = [h for h in missing if len(cache.get(h, {})) < len(TEXT_METRICS)]
+    for start in range(0, len(incomplete), chunk_size):
+        chunk = incomplete[start:start + chunk_size]
+        for body in session.exec(select(CfrContent).where(CfrContent.content_hash.in_(chunk))):
+            values = cache.setdefault(body.content_hash, {})
+            doc = TextAnalysis(body.content)
+            for metric_id, (_, metric_func) in TEXT_METRICS.items():
+                if metric_id not in values:
+                    values[metric_id] = metric_func(doc)
+                    new_rows.append(dict(content_hash=body.content_hash, metric_id=metric_id, value=values[metric_id]))
+            if citations is not None and doc._citations is not None:
+                citations[body.content_hash] = doc._citations
+    return new_rows
+
+
+def _compute_shard(session, title_id: int, issue_date: datetime, cache: dict, citations: dict):
+    """Return the missing CfrMetric rows, new CfrContentMetric rows and CfrCitation rows for one (title, date)."""
+    texts = session.exec(
+        select(CfrText.section_id, CfrText.content_hash)
+        .where(CfrText.title_id == title_id, CfrText.issue_date == issue_date)
+    ).all()
+    visited = _get_metric_set(session, title_id, issue_date)
+    content_rows = _fill_content_metrics(session, {content_hash for _, content_hash in texts}, cache, citations)
+    rows = [
+        dict(title_id=title_id, section_id=section_id, issue_date=issue_date, metric_id=metric_id, value=cache[content_hash][metric_id])
+        for section_id, content_hash in texts
+        for metric_id in TEXT_METRICS
+        if (section_id, metric_id) not in visited
+    ]
+    depths, citation_rows = _shard_citations(session, title_id, issue_date, dict(texts), citations)
+    rows.extend(
+        dict(title_id=title_id, section_id=section_id, issue_date=issue_date, metric_id=CITATION_DEPTH_ID, value=depth)
+        for section_id, depth in depths.items()
+        if (section_id, CITATION_DEPTH_ID) not in visited
+    )
+    return rows, content_rows, citation_rows
+
+
+def _shard_citations(session, title_id: int, issue_date: datetime, hashes: dict, citations: dict, chunk_size = 500):
+    """Citation depth per section of one (title, date), and the shard's CfrCitation rows.
+
+    `hashes` maps section ids to content hashes. Edges of sections whose body
+    is unchanged since the title's last completed shard are reused from that
+    date. New or modified bodies take their citations from `citations` (the
+    same `TextAnalysis` pass as the metrics) and only bodies not analyzed
+    there are read and parsed, then added to it. The depths come from
+    one pass over the shard's citation graph (see `citations.citation_depths`).
+    """
+    parts = dict(session.exec(
+        select(CfrDimension.section_id, CfrDimension.part_id)
+        .where(CfrDimension.title_id == title_id, CfrDimension.issue_date == issue_date)
+    ).all())
+    previous_date = session.exec(
+        select(func.max(MetricShard.issue_date))
+        .where(MetricShard.title_id == title_id, MetricShard.issue_date < issue_date,
+               MetricShard.metric_count >= SHARD_METRIC_COUNT)
+    ).one()
+    edges = {}
+    if previous_date is not None:
+        previous = session.exec(
+            select(CfrText.section_id, CfrText.content_hash)
+            .where(CfrText.title_id == title_id, CfrText.issue_date == previous_date)
+        ).all()
+        unchanged = {section_id for section_id, content_hash in previous if hashes.get(section_id) == content_hash}
+        edges = {section_id: set() for section_id in unchanged}
+        for section_id, target_title_id, target_kind, target_id in session.exec(
+            select(CfrCitation.section_id, CfrCitation.target_title_id, CfrCitation.target_kind, CfrCitation.target_id)
+            .where(CfrCitation.title_id == title_id, CfrCitation.issue_date == previous_date)
+        ):
+            if section_id in unchanged:
+                edges[section_id].add((target_title_id, target_kind, target_id))
+    changed = {}
+    for section_id, content_hash in hashes.items():
+        if section_id not in edges:
+            changed.setdefault(content_hash, []).append(section_id)
+    unparsed = [content_hash for content_hash in changed if content_hash not in citations]
+    for start in range(0, len(unparsed), chunk_size):
+        chunk = unparsed[start:start + chunk_size]
+        for body in session.exec(select(CfrContent).where(CfrContent.content_hash.in_(chunk))):
+            citations[body.content_hash] = TextAnalysis(body.content).citations
+    for content_hash, section_ids in changed.items():
+        for section_id in section_ids:
+            edges[section_id] = section_citations(title_id, section_id, citations.get(content_hash, set()))
+    depths = citation_depths(title_id, {section_id: parts.get(section_id) for section_id in hashes}, edges)
+    citation_rows = [
+        dict(title_id=title_id, issue_date=issue_date, section_id=section_id,
+             target_title_id=target_title_id, target_kind=target_kind, target_id=target_id)
+        for section_id, targets in edges.items()
+        for target_title_id, target_kind, target_id in targets
+    ]
+    return depths, citation_rows
+
+
+_worker_engine = None
+_worker_cache = {}
+_worker_citations = {}
+
+
+def _init_metric_worker(url: str):
+    global _worker_engine
+    _worker_engine = create_engine(url, connect_args={"check_same_thread": False})
+
+
+def _compute_shard_worker(shard):
+    title_id, issue_date = shard
+    with Session(_worker_engine) as session:
+        rows, content_rows, citation_rows = _compute_shard(session, title_id, issue_date, _worker_cache, _worker_citations)
+    return title_id, issue_date, rows, content_rows, citation_rows
+
+
+def plan_compute(engine, title_ids, start_dt: datetime, end_dt: datetime) -> list:
+    """List the (title_id, issue_date) snapshots in the range that have text.
+
+    Runs one grouped query over `CfrText` rather than probing every calendar
+    day, and computes nothing, so it doubles as a dry run. Each entry has
+    `title_id`, `issue_date`, `sections` and `done` (already marked complete
+    in `MetricShard`). `title_ids` may be None for every title.
+    """
     with Session(engine) as session:
-        # Generate a range of dates
-        for issue_date in pd.date_range(start=start_dt, end=end_dt, freq='D'):
-            texts = session.exec(select(CfrText).where(CfrText.issue_date == issue_date and CfrText.title_id == title_id))
-            visited = _get_metric_set(engine, title_id, issue_date)
-            for text in texts:
-                for metric_id, m in enumerate(METRICS):
-                    key = _get_metric_key(title_id, issue_date, text.section_id, metric_id)
-                    if key in visited:
-                        continue
-                    visited.add(key)
-                    _, compute_func = m
-                    result = compute_func(text.content)
-                    metric = CfrMetric(title_id= title_id, section_id=text.section_id, issue_date=text.issue_date, metric_id=metric_id, value=result)
-                    metrics.append(metric)
-                    if len(metrics) >= batch_size:
-                        session.add_all(metrics)
-                        session.commit()
-                        metrics = []
-        if metrics:
-            session.add_all(metrics)
-            session.commit()
-            
+        query = (select(CfrText.title_id, CfrText.issue_date, func.count(CfrText.section_id))
+                 .where(CfrText.issue_date >= start_dt, CfrText.issue_date <= end_dt))
+        if title_ids is not None:
+            query = query.where(CfrText.title_id.in_(list(title_ids)))
+        shards = session.exec(query.group_by(CfrText.title_id, CfrText.issue_date)
+                              .order_by(CfrText.title_id, CfrText.issue_date)).all()
+        done = set(session.exec(
+            select(MetricShard.title_id, MetricShard.issue_date)
+            .where(MetricShard.issue_date >= start_dt, MetricShard.issue_date <= end_dt,
+                   MetricShard.metric_count >= SHARD_METRIC_COUNT)
+        ).all())
+    return [dict(title_id=title_id, issue_date=issue_date, sections=sections, done=(title_id, issue_date) in done)
+            for title_id, issue_date, sections in shards]
+
+
+def _write_shard(writer, title_id: int, issue_date: datetime, rows: list, content_rows: list, citation_rows: list) -> bool:
+    """Queue one shard's rows and mark it complete in `MetricShard` unless a batch failed."""
+    failed = writer.failed
+    writer.add_many(CfrContentMetric, content_rows, mode="ignore")
+    writer.add_many(CfrCitation, citation_rows, mode="ignore")
+    writer.add_many(CfrMetric, rows)
+    writer.flush()
+    if writer.failed != failed:
+        return False
+    refresh_rollups(writer, title_id, issue_date)
+    writer.add(MetricShard, dict(title_id=title_id, issue_date=issue_date, metric_count=SHARD_METRIC_COUNT,
+                                 completed_at=datetime.now()), mode="upsert")
+    return True
+
+
+def compute_metric_parallel(engine, title_ids, start_dt: datetime, end_dt: datetime, workers: int = None, batch_size = 10000, mode = "insert", progress = None) -> dict:
+    """Compute metrics for many titles and dates in a process pool.
+
+    The work is split into (title_id, issue_date) shards. Workers read with
+    their own connections and send rows back to this process, which is the
+    only writer. Each shard's rows and its `MetricShard` marker are committed
+    together, so after a crash a rerun skips every shard that finished.
+    `title_ids` may be None for every title.
+    """
+    shards = [(shard["title_id"], shard["issue_date"])
+              for shard in plan_compute(engine, title_ids, start_dt, end_dt) if not shard["done"]]
+    if not shards:
+        print("All shards already computed.")
+    return compute_shards(engine, shards, workers=workers, batch_size=batch_size, mode=mode, progress=progress)
+
+
+def compute_shards(engine, shards: list, workers: int = 1, batch_size = 10000, mode = "insert", progress = None) -> dict:
+    """Compute and write the metrics of the given (title_id, issue_date) shards.
+
+    With `workers` of 1 the shards are computed in this process, otherwise in
+    a process pool (None for one per CPU). Either way this process is the only
+    writer and commits each shard as it finishes. `progress(title_id,
+    issue_date, rows)` is called after every commit; an exception raised from
+    it stops the run and keeps the shards already committed.
+    """
+    stats = {"shards": len(shards), "rows": 0, "failed": 0, "seconds": 0.0}
+    if not shards:
+        return stats
+    start = time.perf_counter()
+    with BulkWriter(engine, batch_size, mode) as writer:
+        if workers == 1:
+            cache = {}
+            citations = {}
+            with Session(engine) as session:
+                results = ((title_id, issue_date, *_compute_shard(session, title_id, issue_date, cache, citations))
+                           for title_id, issue_date in shards)
+                _write_shards(writer, results, len(shards), stats, start, progress)
+        else:
+            url = engine.url.render_as_string(hide_password=False)
+            with multiprocessing.Pool(workers, initializer=_init_metric_worker, initargs=(url,)) as pool:
+                _write_shards(writer, pool.imap_unordered(_compute_shard_worker, shards), len(shards), stats, start, progress)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def _write_shards(writer, results, total: int, stats: dict, start: float, progress):
+    for done, (title_id, issue_date, rows, content_rows, citation_rows) in enumerate(results, 1):
+        if not _write_shard(writer, title_id, issue_date, rows, content_rows, citation_rows):
+            stats["failed"] += 1
+        writer.commit()
+        stats["rows"] += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"[{done}/{total}] Title {title_id} ({issue_date:%Y-%m-%d}): {len(rows)} metrics | "
+              f"{done / elapsed:.1f} shards/s")
+        if progress is not None:
+            progress(title_id, issue_date, len(rows))
+
 def _get_agency_dict(engine) -> dict:
     with Session(engine) as session:
         return {f"{agency.short_name}": agency 
                     for agency in session.exec(select(Agency)).all()}  
  
-def _get_metric_key(title_id, issue_date, section_id, metric_id):
-     return f"{title_id}:{issue_date}:{section_id}:{metric_id}"
-             
-def _get_metric_set(engine, title_id, issue_date) -> set:
-    with Session(engine) as session:
-        return set([_get_metric_key(cfr.title_id, cfr.issue_date, cfr.section_id, cfr.metric_id)
-                    for cfr in session.exec(select(CfrMetric).where(CfrMetric.title_id == title_id and CfrMetric.issue_date == issue_date)).all()])  
+def _get_metric_set(session, title_id, issue_date) -> set:
+    """(section_id, metric_id) pairs already stored for one title and date."""
+    return set(session.exec(
+        select(CfrMetric.section_id, CfrMetric.metric_id)
+        .where(CfrMetric.title_id == title_id, CfrMetric.issue_date == issue_date)
+    ).all())
 
 def main():
     connect_args = {"check_same_thread": False}
@@ -182,8 +729,49 @@ def main():
 
     print(html_table)
     # print(json_output)
+
+
+def benchmark(xml_dir: str = "./api/xml_data/title1", repeat: int = 5):
+    """Time the shared TextAnalysis pass against one scan per metric on the bundled XML."""
+    from parser import StreamingTitleXMLParser, xml_files
+
+    texts = [row["text"] for file_path in xml_files(xml_dir)
+             for row in StreamingTitleXMLParser(file_path)]
+    # the metric functions as they were before TextAnalysis: each one rescans the text
+    separate = [
+        lambda t: len(t.split()),
+        lambda t: t.count('the'),
+        lambda t: len(extract_citations(t)),
+        lambda t: len(set(t.split())),
+    ]
+
+    def run_separate():
+        return [[func(t) for func in separate] for t in texts]
+
+    def run_shared():
+        return [list(compute_all(t, range(CITATION_DEPTH_ID)).values()) for t in texts]
+
+    assert run_separate() == run_shared()
+    results = {}
+    for name, run in (("one pass per metric", run_separate), ("shared analysis", run_shared)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        results[name] = (time.perf_counter() - start) / repeat
+        print(f"{name:>20}: {len(texts)} sections in {results[name] * 1000:.1f} ms ({len(texts) / results[name]:.0f} sections/s)")
+    print(f"speedup: {results['one pass per metric'] / results['shared analysis']:.2f}x")
+    return results
+
+
 if __name__ == "__main__":    
-    main()
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    elif sys.argv[1:2] == ["reset"]:
+        engine = create_engine(sqlite_url)
+        create_db_and_tables(engine)
+        reset_metrics(engine, sys.argv[2:])
+    else:
+        main()
 
 
   
@@ -2,14 +2,18 @@ from pathlib import Path
 from fastapi import FastAPI
 import httpx
 from sqlmodel import Field, Session, SQLModel, create_engine, select, insert, delete
-from datetime import datetime, date
+from datetime import datetime, date, timezone
 from pydantic import field_validator
 from sqlalchemy.dialects import sqlite
-from sqlalchemy import text
+from sqlalchemy import Index, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from fastapi.responses import Response
 from httpx import Timeout
 import asyncio
+import hashlib
 import os
+import sqlite3
 
 METRICS = ['Average words per group',
            'Keyword count per group',
@@ -19,6 +23,8 @@ METRICS = ['Average words per group',
            'Citation depth']
 
 class CfrDimension(SQLModel, table=True):
+    __table_args__ = (Index("ix_cfrdimension_agency_date", "agency_slug", "issue_date"),
+                      Index("ix_cfrdimension_title_date", "title_id", "issue_date"))
     title_id: int = Field(primary_key=True)
     section_id: str = Field(primary_key=True, max_length=128)
     issue_date: datetime = Field(primary_key=True)
@@ -36,18 +42,85 @@ class CfrDimension(SQLModel, table=True):
 
     
 class CfrText(SQLModel, table=True):
+    # the primary key puts section_id second, so per (title, date) reads need their own index
+    __table_args__ = (Index("ix_cfrtext_title_date", "title_id", "issue_date"),)
     title_id: int = Field(primary_key=True)
     section_id: str = Field(primary_key=True)
     issue_date: datetime = Field(primary_key=True)
+    content_hash: str = Field(index=True, foreign_key="cfrcontent.content_hash", max_length=64)
+
+
+class CfrContent(SQLModel, table=True):
+    """Section text stored once per unique body; `CfrText` rows point here by hash."""
+    content_hash: str = Field(primary_key=True, max_length=64)
     content : str
+
+
+class CfrContentMetric(SQLModel, table=True):
+    """Metric values per unique body, so unchanged sections are computed once."""
+    content_hash: str = Field(primary_key=True, max_length=64)
+    metric_id: int = Field(primary_key=True)
+    value: float
     
+class CfrCitation(SQLModel, table=True):
+    """A reference from a section to a section or part, e.g. "§ 1.2", "part 5" or "40 CFR 52.21"."""
+    title_id: int = Field(primary_key=True)
+    issue_date: datetime = Field(primary_key=True)
+    section_id: str = Field(primary_key=True)
+    target_title_id: int = Field(primary_key=True)
+    target_kind: str = Field(primary_key=True, max_length=8)  # "section" or "part"
+    target_id: str = Field(primary_key=True)
+
+
+class CfrContentSignature(SQLModel, table=True):
+    """MinHash signature per unique body for the similarity index; empty for bodies with no words."""
+    content_hash: str = Field(primary_key=True, max_length=64)
+    signature: bytes
+
+
 class CfrMetric(SQLModel, table=True):
+    # covers getTable's section-level scan: metric + date range, then join keys and value
+    # and the per-shard reads and rollup refresh of one (title, date)
+    __table_args__ = (Index("ix_cfrmetric_metric_date", "metric_id", "issue_date", "title_id", "section_id", "value"),
+                      Index("ix_cfrmetric_title_date", "title_id", "issue_date", "section_id", "metric_id", "value"))
     title_id: int = Field(primary_key=True)
     section_id: str = Field(primary_key=True)
     issue_date: datetime = Field(primary_key=True)
     metric_id: int = Field(primary_key=True)
     value: float
     
+class MetricRollup(SQLModel, table=True):
+    """Metric totals per hierarchy level, agency and date, kept in step with `CfrMetric`.
+
+    `level` is 0=title .. 4=subpart; missing labels are stored as '' so they
+    can be part of the key.
+    """
+    level: int = Field(primary_key=True)
+    metric_id: int = Field(primary_key=True)
+    agency_slug: str = Field(primary_key=True)
+    issue_date: datetime = Field(primary_key=True)
+    title_id: int = Field(primary_key=True)
+    title: str = Field(primary_key=True)
+    level_value: str = Field(primary_key=True)
+    value: float
+
+
+class MetricShard(SQLModel, table=True):
+    """A (title, issue_date) whose metrics have all been written, so resumed runs can skip it."""
+    title_id: int = Field(primary_key=True)
+    issue_date: datetime = Field(primary_key=True)
+    metric_count: int
+    completed_at: datetime
+
+
+class DataVersion(SQLModel, table=True):
+    """Version counters, one row each: `DATA_VERSION_ID` is bumped whenever served data
+    changes and keys the API response caches; `AGENCY_VERSION_ID` only when agencies are reloaded."""
+    id: int = Field(default=1, primary_key=True)
+    version: int
+    updated_at: datetime
+
+    
 class Agency(SQLModel, table=True):
     slug: str = Field(primary_key=True, max_length=255)  # Assuming slug is unique and has a max length of 255 characters
     name: str
@@ -97,5 +170,146 @@ class TitleContent(SQLModel, table=True):
     content_type: str
     
 
+def hash_content(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+DATA_VERSION_ID = 1
+AGENCY_VERSION_ID = 2
+
+
+def bump_data_version(conn, version_id: int = DATA_VERSION_ID):
+    """Increment the data version (or another `DataVersion` counter) on `conn`, a connection, session or `BulkWriter`.
+
+    Runs in the caller's transaction, so the new version commits together with
+    the rows that changed.
+    """
+    table = DataVersion.__table__
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    stmt = sqlite.insert(table).values(id=version_id, version=1, updated_at=now)
+    conn.execute(stmt.on_conflict_do_update(index_elements=["id"], set_={"version": table.c.version + 1, "updated_at": now}))
+
+
+def get_data_version(engine, version_id: int = DATA_VERSION_ID) -> tuple:
+    """Return (version, updated_at in UTC); (0, None) before anything was written."""
+    with Session(engine) as session:
+        row = session.get(DataVersion, version_id)
+    return (row.version, row.updated_at) if row else (0, None)
+
+
+def enable_wal(engine):
+    """Put every connection of `engine` in WAL mode so readers and the writer don't block each other."""
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+    return engine
+
+
+def create_read_engine(sqlite_file_name: str, pool_size: int = 8):
+    """Pooled engine of read-only connections to `sqlite_file_name` for query endpoints.
+
+    Connections are opened with `mode=ro`, so a query can never take the
+    write lock; with the file in WAL mode they read the last committed state
+    while ingestion or metric computation is writing. Checkout blocks once
+    `pool_size` connections are in use.
+    """
+    uri = f"{Path(sqlite_file_name).resolve().as_uri()}?mode=ro"
+    return create_engine(
+        "sqlite://",
+        creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False),
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+    )
+
+
+# FTS5 index over the section bodies, kept in step with `CfrContent` by triggers.
+# It indexes CfrContent's rowid, so run `rebuild_keyword_index` after a VACUUM.
+KEYWORD_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cfrcontent_fts USING fts5("
+    "content, content='cfrcontent', tokenize='unicode61 remove_diacritics 0')",
+    # one row per term occurrence (term, doc, col, offset), for counting hits and phrases
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cfrcontent_vocab USING fts5vocab(cfrcontent_fts, 'instance')",
+    "CREATE TRIGGER IF NOT EXISTS cfrcontent_fts_insert AFTER INSERT ON cfrcontent BEGIN "
+    "INSERT INTO cfrcontent_fts(rowid, content) VALUES (new.rowid, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS cfrcontent_fts_delete AFTER DELETE ON cfrcontent BEGIN "
+    "INSERT INTO cfrcontent_fts(cfrcontent_fts, rowid, content) VALUES ('delete', old.rowid, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS cfrcontent_fts_update AFTER UPDATE ON cfrcontent BEGIN "
+    "INSERT INTO cfrcontent_fts(cfrcontent_fts, rowid, content) VALUES ('delete', old.rowid, old.content); "
+    "INSERT INTO cfrcontent_fts(rowid, content) VALUES (new.rowid, new.content); END",
+]
+
+
+def create_keyword_index(engine) -> bool:
+    """Create the FTS5 keyword index and its triggers, indexing existing bodies the first time.
+
+    Returns False (with a warning) when SQLite was built without FTS5.
+    """
+    with engine.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cfrcontent_fts'").first() is not None
+        try:
+            for statement in KEYWORD_INDEX_DDL:
+                conn.exec_driver_sql(statement)
+        except OperationalError as e:
+            print(f"Warning: keyword index not available: {e}")
+            return False
+        if not exists:
+            conn.exec_driver_sql("INSERT INTO cfrcontent_fts(cfrcontent_fts) VALUES ('rebuild')")
+    return True
+
+
+def rebuild_keyword_index(engine):
+    """Reindex every `CfrContent` body, e.g. after a VACUUM renumbered its rowids."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO cfrcontent_fts(cfrcontent_fts) VALUES ('rebuild')")
+
+
+def backfill_rollups(engine) -> bool:
+    """Fill `MetricRollup` on a database whose metrics were computed before rollups existed."""
+    with engine.connect() as conn:
+        if (conn.exec_driver_sql("SELECT 1 FROM metricrollup LIMIT 1").first() is not None
+                or conn.exec_driver_sql("SELECT 1 FROM cfrmetric LIMIT 1").first() is None):
+            return False
+    from metrics import rebuild_rollups
+
+    print(f"Built rollups for {rebuild_rollups(engine)} (title, date) snapshots.")
+    return True
+
+
+def migrate_cfrtext_content(engine) -> bool:
+    """Move section text of a database from before `CfrContent` existed into it.
+
+    Older databases kept the full text in `cfrtext.content`. Each distinct
+    body is copied into `cfrcontent` under its hash and `cfrtext` is rebuilt
+    with `content_hash`, in one transaction. Returns True if anything was migrated.
+    """
+    with engine.begin() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(cfrtext)")}
+        if "content" not in columns:
+            return False
+        print("Migrating cfrtext.content into cfrcontent...")
+        conn.connection.driver_connection.create_function("hash_content", 1, hash_content, deterministic=True)
+        CfrContent.__table__.create(conn, checkfirst=True)
+        conn.exec_driver_sql("INSERT OR IGNORE INTO cfrcontent (content_hash, content) "
+                             "SELECT hash_content(content), content FROM cfrtext GROUP BY content")
+        conn.exec_driver_sql("ALTER TABLE cfrtext RENAME TO cfrtext_before_content")
+        CfrText.__table__.create(conn)
+        conn.exec_driver_sql("INSERT INTO cfrtext (title_id, section_id, issue_date, content_hash) "
+                             "SELECT title_id, section_id, issue_date, hash_content(content) FROM cfrtext_before_content")
+        conn.exec_driver_sql("DROP TABLE cfrtext_before_content")
+    return True
+
+
 def create_db_and_tables(engine):
-    SQLModel.metadata.create_all(engine)
\ No newline at end of file
+    migrate_cfrtext_content(engine)
+    SQLModel.metadata.create_all(engine)
+    # create_all skips tables that already exist, so add indexes introduced later
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    create_keyword_index(engine)
+    backfill_rollups(engine)
\ No newline at end of file
@@ -1,6 +1,69 @@
+import gzip
 import os
+import re
 import xml.etree.ElementTree as ET
+
+try:
+    from lxml.etree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TYPE_MAP = {'TITLE': 'title', 'CHAPTER': 'chapter', 'SUBCHAP': 'subchapter', 'PART': 'part', 'SUBPART': 'subpart', 'SECTION': 'section'}
+
+# on-disk XML snapshot formats by compression
+XML_SUFFIXES = {'none': '.xml', 'gzip': '.xml.gz', 'zstd': '.xml.zst'}
+XML_FILE_RE = re.compile(r'title-\d+_\d{4}-\d{2}-\d{2}\.xml(\.gz|\.zst)?')
+ZSTD_LEVEL = 10
+
+
+def xml_compression(file_path) -> str:
+    """Compression of an XML snapshot, from its file name."""
+    name = str(file_path)
+    for compression, suffix in XML_SUFFIXES.items():
+        if compression != 'none' and name.endswith(suffix):
+            return compression
+    return 'none'
+
+
+def xml_files(dir_path) -> list:
+    """Sorted paths of the complete XML snapshots (any compression) in a directory."""
+    if not os.path.isdir(dir_path):
+        return []
+    return sorted(os.path.join(dir_path, name) for name in os.listdir(dir_path) if XML_FILE_RE.fullmatch(name))
+
+
+def open_xml(file_path, mode='rb', compression=None, level=None):
+    """Open an XML snapshot as a binary stream, (de)compressing on the fly.
+
+    `compression` ("none", "gzip" or "zstd") defaults to the one implied by
+    the file name. `level` is the compression level when writing, by default
+    the smallest output (gzip 9, zstd `ZSTD_LEVEL`). zstd needs the optional
+    zstandard package.
+    """
+    compression = compression or xml_compression(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, mode, compresslevel=level or 9)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd-compressed XML needs the zstandard package (pip install zstandard)")
+        raw = open(file_path, mode)
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return zstandard.ZstdCompressor(level=level or ZSTD_LEVEL).stream_writer(raw, closefd=True)
+    return open(file_path, mode)
+
+
 class TitleXMLParser:
+    """Iterate the sections of a title XML file, loading the whole tree first.
+
+    Each record's `keys` and `dims` come from the section's own ancestors, so
+    a section with no subchapter or subpart has no such key.
+    """
     def __init__(self, file_path):
         self.file_path = file_path
         self.stack = []
@@ -9,45 +72,103 @@ class TitleXMLParser:
         self._initialize()
     
     def _initialize(self):
-        tree = ET.parse(self.file_path)
+        with open_xml(self.file_path) as f:
+            tree = ET.parse(f)
         root = tree.getroot()
-        self.stack.append(root)
+        # each entry carries the keys and dims of its ancestors
+        self.stack.append((root, {}, {}))
     
     def __iter__(self):
         return self
     
     def __next__(self):
-        if not self.stack:
-            raise StopIteration
+        while self.stack:
+            elem, keys, dims = self.stack.pop()
+            t = elem.get('TYPE')
+            n = elem.get('N')
 
-        elem = self.stack.pop()
-        t = elem.get('TYPE')
-        n = elem.get('N')
-        label = None
+            # Update keys and dims
+            if t in TYPE_MAP:
+                label = None
+                for child in elem:
+                    if child.tag.startswith('HEAD'):
+                        label = child.text
+                        break
+                key = TYPE_MAP[t]
+                keys = {**keys, key: f"{n}"}
+                dims = {**dims, key: label}
+            self.keys, self.dims = keys, dims
 
-        if t in [ 'TITLE', 'CHAPTER', 'SUBCHAP', 'PART', 'SUBPART', 'SECTION']:
+            # Add child DIV elements to queue
             for child in elem:
-                if child.tag.startswith('HEAD'):
-                    label = child.text
-                    break
-        
-        # Update keys and dims
-        type_map = {'TITLE': 'title', 'CHAPTER': 'chapter', 'SUBCHAP': 'subchapter', 'PART': 'part', 'SUBPART': 'subpart', 'SECTION': 'section'}
-        if t in type_map:
-            key = type_map[t]
-            self.dims[key] = label
-            self.keys[key] = f"{n}"
-        
-        # Add child DIV elements to queue
-        for child in elem:
-            if child.tag.startswith('DIV'):
-                self.stack.append(child)
-                
-        if t == 'SECTION':
-            paragraphs = ' '.join(''.join(p.itertext()) for p in elem.findall('.//P'))
-            return {'dims': self.dims.copy(), 'keys': self.keys.copy(), 'text': paragraphs}
-        
-        return self.__next__()
+                if child.tag.startswith('DIV'):
+                    self.stack.append((child, keys, dims))
+
+            if t == 'SECTION':
+                paragraphs = ' '.join(''.join(p.itertext()) for p in elem.findall('.//P'))
+                return {'dims': dims.copy(), 'keys': keys.copy(), 'text': paragraphs}
+        raise StopIteration
+
+
+class StreamingTitleXMLParser:
+    """Iterate the sections of a title XML file with `iterparse`.
+
+    Yields the same `{'dims', 'keys', 'text'}` records as `TitleXMLParser`,
+    each as soon as its section closes, and finished subtrees are dropped so
+    memory does not grow with the size of the file. Uses lxml when it is
+    installed. Records come out in document order (`TitleXMLParser` walks
+    the tree last child first).
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._rows = self._parse()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+    def _parse(self):
+        with open_xml(self.file_path) as f:
+            yield from self._parse_stream(f)
+
+    def _parse_stream(self, f):
+        # each open element is [elem, reachable, key, label, head_seen]
+        stack = []
+        section_depth = 0
+        for event, elem in iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                # like TitleXMLParser, only descend through DIV children
+                reachable = not stack or (stack[-1][1] and elem.tag.startswith('DIV'))
+                key = TYPE_MAP.get(elem.get('TYPE')) if reachable else None
+                stack.append([elem, reachable, key, None, False])
+                if key == 'section':
+                    section_depth += 1
+                continue
+
+            _, _, key, label, _ = stack.pop()
+            parent = stack[-1] if stack else None
+            if parent is not None and parent[2] and not parent[4] and elem.tag.startswith('HEAD'):
+                parent[3] = elem.text
+                parent[4] = True
+
+            if key == 'section':
+                keys, dims = {}, {}
+                for frame in stack:
+                    if frame[2]:
+                        keys[frame[2]] = f"{frame[0].get('N')}"
+                        dims[frame[2]] = frame[3]
+                keys['section'] = f"{elem.get('N')}"
+                dims['section'] = label
+                paragraphs = ' '.join(''.join(p.itertext()) for p in elem.findall('.//P'))
+                section_depth -= 1
+                yield {'dims': dims, 'keys': keys, 'text': paragraphs}
+
+            # keep section bodies until the section itself has been read
+            if parent is not None and section_depth == 0:
+                parent[0].remove(elem)
+
 
 def main():
     file_path = 'api/xml_data/title1/title-1_2015-12-18.xml'
@@ -20,10 +20,10 @@ The frontend can then immediately query /metric_json and display charts.
 
 import asyncio
 from datetime import datetime
-from pathlib import Path
 from sqlmodel import create_engine
 
 from fetch_data import (
+    _get_xml_path,
     download_agencies,
     download_titles,
     download_tile_xml_async,
@@ -66,9 +66,8 @@ async def seed_db():
         print(f"❌ Failed to download Title {title_id}")
         return
 
-    # Check if file exists
-    fmt_dt = issue_date.strftime("%Y-%m-%d")
-    file_path = Path(f"./api/xml_data/title{title_id}/title-{title_id}_{fmt_dt}.xml")
+    # Check if file exists, in whichever compression it was stored
+    file_path = _get_xml_path(title_id, issue_date)
     if not file_path.exists():
         print(f"❌ XML file not found: {file_path}")
         return
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Near-duplicate detection behind the "Lexical similarity" metric.
+
+Each unique section body gets a MinHash signature of its word 3-gram
+shingles, stored in `CfrContentSignature` so a body is hashed once however
+many dates it appears on. Signatures are cut into LSH bands and only
+sections sharing a band bucket are compared, instead of every pair of
+sections in the snapshot.
+
+A snapshot "as of" a date holds, for every title, its latest ingested issue
+date on or before that date, so sections are compared across titles and
+agencies. A section's metric value is its highest estimated Jaccard
+similarity to any other section of the snapshot (1.0 when another section
+has the same body).
+
+Usage:
+  From repo root:
+    python api/similarity.py [start_date] [end_date]
+"""
+
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+from sqlmodel import Session, create_engine, func, select
+from bulk_writer import BulkWriter
+from metrics import SNAPSHOT_METRICS, refresh_rollups
+from models import CfrContent, CfrContentSignature, CfrDimension, CfrMetric, CfrText, get_data_version
+
+SIMILARITY_METRIC_ID = SNAPSHOT_METRICS["Lexical similarity"]
+
+# 32 bands of 4 rows: pairs above ~0.42 Jaccard share a bucket with high probability.
+# Changing these (or SEED) invalidates the signatures stored in CfrContentSignature.
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+SEED = 1
+
+WORD_RE = re.compile(r"\w+")
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_SHIFT = np.uint64(32)
+_rng = np.random.default_rng(SEED)
+# multiply-add-shift hash family: h(x) = ((a * x + b) mod 2**64) >> 32
+_A = (_rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str) -> np.ndarray:
+    """Unique 32-bit hashes of the lowercase word 3-grams of `text`."""
+    hashes = np.array([zlib.crc32(word.encode("utf-8")) for word in WORD_RE.findall(text.lower())], dtype=np.uint64)
+    if not len(hashes):
+        return hashes
+    size = min(SHINGLE_SIZE, len(hashes))
+    mixed = np.zeros(len(hashes) - size + 1, dtype=np.uint64)
+    for offset in range(size):
+        mixed = mixed * _MIX + hashes[offset:len(hashes) - size + 1 + offset]
+    return np.unique(mixed >> _SHIFT)
+
+
+def minhash(text: str, chunk_size: int = 2048) -> np.ndarray:
+    """MinHash signature of `text` (NUM_PERM uint32 values); empty when it has no words."""
+    values = shingles(text)
+    if not len(values):
+        return np.empty(0, dtype=np.uint32)
+    signature = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint64)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        hashed = (_A[:, None] * chunk[None, :] + _B[:, None]) >> _SHIFT
+        np.minimum(signature, hashed.min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def load_signatures(session, hashes, cache: dict, chunk_size: int = 500) -> list:
+    """Make sure `cache` holds the signature of every content hash.
+
+    Stored signatures are loaded and missing ones computed from the body.
+    Returns the new `CfrContentSignature` rows for the caller to write.
+    """
+    new_rows = []
+    missing = [h for h in hashes if h not in cache]
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        for row in session.exec(select(CfrContentSignature).where(CfrContentSignature.content_hash.in_(chunk))):
+            cache[row.content_hash] = np.frombuffer(row.signature, dtype=np.uint32)
+    missing = [h for h in missing if h not in cache]
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        for body in session.exec(select(CfrContent).where(CfrContent.content_hash.in_(chunk))):
+            signature = minhash(body.content)
+            cache[body.content_hash] = signature
+            new_rows.append(dict(content_hash=body.content_hash, signature=signature.tobytes()))
+    return new_rows
+
+
+def load_snapshot(session, as_of: datetime) -> list:
+    """(title_id, section_id, issue_date, agency_slug, content_hash) of every section in the CFR as of a date."""
+    latest = (select(CfrText.title_id, func.max(CfrText.issue_date).label("issue_date"))
+              .where(CfrText.issue_date <= as_of).group_by(CfrText.title_id).subquery())
+    return session.exec(
+        select(CfrText.title_id, CfrText.section_id, CfrText.issue_date, CfrDimension.agency_slug, CfrText.content_hash)
+        .join(latest, (latest.c.title_id == CfrText.title_id) & (latest.c.issue_date == CfrText.issue_date))
+        .join(CfrDimension, (CfrDimension.title_id == CfrText.title_id)
+              & (CfrDimension.issue_date == CfrText.issue_date)
+              & (CfrDimension.section_id == CfrText.section_id))
+        .order_by(CfrText.title_id, CfrText.section_id)
+    ).all()
+
+
+class SimilarityIndex:
+    """LSH index over the sections of one snapshot.
+
+    Sections sharing a body share one signature. Bodies without words are
+    left out of the buckets and only match sections with the same body.
+    """
+    def __init__(self, sections: list, signatures: dict):
+        self.sections = sections
+        bodies = {}
+        for section in sections:
+            bodies.setdefault(section[4], len(bodies))
+        self.body_ids = np.array([bodies[section[4]] for section in sections], dtype=np.int64)
+        self.copies = np.bincount(self.body_ids, minlength=len(bodies))
+        self.signed = np.array([len(signatures[h]) > 0 for h in bodies], dtype=bool)
+        self.signatures = np.zeros((len(bodies), NUM_PERM), dtype=np.uint32)
+        for h, body in bodies.items():
+            if self.signed[body]:
+                self.signatures[body] = signatures[h]
+        self.bands = self._band_keys(self.signatures)
+        self._positions = {(section[0], section[1]): i for i, section in enumerate(sections)}
+
+    @staticmethod
+    def _band_keys(signatures: np.ndarray) -> np.ndarray:
+        keys = np.zeros((len(signatures), BANDS), dtype=np.uint64)
+        rows = signatures.reshape(len(signatures), BANDS, ROWS).astype(np.uint64)
+        for row in range(ROWS):
+            keys = keys * _MIX + rows[:, :, row]
+        return keys
+
+    def max_similarity(self, block_size: int = 256) -> np.ndarray:
+        """Highest similarity of each section to any other section of the snapshot."""
+        best = np.zeros(len(self.copies))
+        signed = np.flatnonzero(self.signed)
+        for band in range(BANDS):
+            order = signed[np.argsort(self.bands[signed, band], kind="stable")]
+            keys = self.bands[order, band]
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            ends = np.r_[starts[1:], len(keys)]
+            for start, end in zip(starts, ends):
+                if end - start > 1:
+                    self._compare_bucket(order[start:end], best, block_size)
+        # sections sharing a body are exact duplicates of each other
+        best[self.copies > 1] = 1.0
+        return best[self.body_ids]
+
+    def _compare_bucket(self, members: np.ndarray, best: np.ndarray, block_size: int):
+        signatures = self.signatures[members]
+        for start in range(0, len(members), block_size):
+            block = signatures[start:start + block_size]
+            similarity = (block[:, None, :] == signatures[None, :, :]).mean(axis=2)
+            # ignore each body's match with itself
+            similarity[np.arange(len(block)), np.arange(start, start + len(block))] = 0.0
+            ids = members[start:start + block_size]
+            best[ids] = np.maximum(best[ids], similarity.max(axis=1))
+
+    def similar(self, title_id: int, section_id: str, threshold: float = 0.5, limit: int = 20,
+                agencies: list = None) -> list:
+        """Sections of the snapshot similar to one section, most similar first.
+
+        Returns None when the section is not in the snapshot. `agencies`
+        restricts the matches to those agency slugs.
+        """
+        position = self._positions.get((title_id, section_id))
+        if position is None:
+            return None
+        body = self.body_ids[position]
+        similarity = np.zeros(len(self.copies))
+        if self.signed[body]:
+            candidates = np.flatnonzero((self.bands == self.bands[body]).any(axis=1) & self.signed)
+            similarity[candidates] = (self.signatures[candidates] == self.signatures[body]).mean(axis=1)
+        similarity[body] = 1.0
+        values = similarity[self.body_ids]
+        values[position] = 0.0
+        matches = np.flatnonzero(values >= max(threshold, 1e-9))
+        agency = self.sections[position][3]
+        results = []
+        for i in matches[np.argsort(-values[matches], kind="stable")]:
+            match_title, match_section, issue_date, match_agency, _ = self.sections[i]
+            if agencies and match_agency not in agencies:
+                continue
+            results.append(dict(title_id=match_title, section_id=match_section, issue_date=issue_date.isoformat(),
+                                agency_slug=match_agency, same_agency=match_agency == agency,
+                                similarity=round(float(values[i]), 4)))
+            if len(results) >= limit:
+                break
+        return results
+
+
+def build_index(session, as_of: datetime, cache: dict = None) -> tuple:
+    """Build the `SimilarityIndex` of the snapshot as of a date; returns (index, new signature rows)."""
+    cache = {} if cache is None else cache
+    sections = load_snapshot(session, as_of)
+    new_rows = load_signatures(session, {section[4] for section in sections}, cache)
+    return SimilarityIndex(sections, cache), new_rows
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def snapshot_index(engine, as_of: datetime, max_entries: int = 2) -> SimilarityIndex:
+    """`build_index` for read-only callers such as the API, cached until the data version changes.
+
+    Signatures missing from the database are computed in memory but not stored.
+    """
+    version, _ = get_data_version(engine)
+    key = (str(engine.url), as_of)
+    with _indexes_lock:
+        entry = _indexes.get(key)
+        if entry is not None and entry[0] == version:
+            _indexes.move_to_end(key)
+            return entry[1]
+    with Session(engine) as session:
+        index, _ = build_index(session, as_of)
+    with _indexes_lock:
+        _indexes[key] = (version, index)
+        _indexes.move_to_end(key)
+        while len(_indexes) > max_entries:
+            _indexes.popitem(last=False)
+    return index
+
+
+def compute_similarity(engine, start_dt: datetime, end_dt: datetime, batch_size = 10000, progress = None) -> dict:
+    """Write the "Lexical similarity" metric of every issue date in the range that has text.
+
+    For each date the snapshot as of that date is indexed, and the sections
+    ingested on that date get their max similarity in `CfrMetric`, replacing
+    earlier values. Signatures are cached across dates and stored, so only
+    new bodies are hashed. Each date commits with its rollups.
+    `progress(issue_date, rows)` is called after every commit.
+    """
+    stats = {"dates": 0, "rows": 0, "signatures": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    cache = {}
+    with Session(engine) as session:
+        dates = session.exec(select(CfrText.issue_date).distinct()
+                             .where(CfrText.issue_date >= start_dt, CfrText.issue_date <= end_dt)
+                             .order_by(CfrText.issue_date)).all()
+    with BulkWriter(engine, batch_size, mode="upsert") as writer:
+        for done, issue_date in enumerate(dates, 1):
+            with Session(engine) as session:
+                index, new_rows = build_index(session, issue_date, cache)
+            values = index.max_similarity()
+            rows = [dict(title_id=title_id, section_id=section_id, issue_date=section_date,
+                         metric_id=SIMILARITY_METRIC_ID, value=float(value))
+                    for (title_id, section_id, section_date, _, _), value in zip(index.sections, values)
+                    if section_date == issue_date]
+            writer.add_many(CfrContentSignature, new_rows, mode="ignore")
+            writer.add_many(CfrMetric, rows)
+            for title_id in sorted({row["title_id"] for row in rows}):
+                refresh_rollups(writer, title_id, issue_date)
+            writer.commit()
+            stats["dates"] += 1
+            stats["rows"] += len(rows)
+            stats["signatures"] += len(new_rows)
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(dates)}] {issue_date:%Y-%m-%d}: {len(rows)} sections against {len(index.sections)} "
+                  f"({len(new_rows)} new signatures) | {stats['rows'] / elapsed:.0f} sections/s")
+            if progress is not None:
+                progress(issue_date, len(rows))
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    start_dt = datetime.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 else datetime(1900, 1, 1)
+    end_dt = datetime.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else datetime.now()
+    engine = create_engine("sqlite:///./api/ecfr.db", connect_args={"check_same_thread": False})
+    stats = compute_similarity(engine, start_dt, end_dt)
+    print(f"Computed similarity for {stats['rows']} sections on {stats['dates']} dates in {stats['seconds']:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the eCFR API, serving the bundled fixtures for offline runs.
+
+Usage:
+  From repo root:
+    python api/stub_ecfr.py [port]
+
+Serves:
+  /api/versioner/v1/versions/title-{N}.json   from api/fixtures/versions/
+  /api/versioner/v1/full/{date}/title-{N}.xml from api/xml_data/title{N}/,
+      answering with the latest bundled snapshot on or before {date}
+      (decompressed if the cache is gzip/zstd compressed)
+
+Point the download functions at it with base_url="http://127.0.0.1:{port}/api".
+"""
+
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from parser import open_xml, xml_files
+
+FIXTURE_DIR = "./api/fixtures"
+XML_DIR = "./api/xml_data"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    fixture_dir = Path(FIXTURE_DIR)
+    xml_dir = Path(XML_DIR)
+
+    def do_GET(self):
+        versions = re.fullmatch(r"/api/versioner/v1/versions/title-(\d+)\.json", self.path)
+        full = re.fullmatch(r"/api/versioner/v1/full/(\d{4}-\d{2}-\d{2})/title-(\d+)\.xml", self.path)
+        if versions:
+            self._send_file(self.fixture_dir / "versions" / f"title-{versions.group(1)}.json", "application/json")
+        elif full:
+            issue_date, title_id = full.groups()
+            snapshots = [Path(path) for path in xml_files(self.xml_dir / f"title{title_id}")
+                         if path.rsplit("_", 1)[1][:10] <= issue_date]
+            self._send_xml(snapshots[-1] if snapshots else None)
+        else:
+            self.send_error(404)
+
+    def _send_file(self, path, content_type: str):
+        if path is None or not path.exists():
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 16):
+                self.wfile.write(chunk)
+
+    def _send_xml(self, path):
+        """Send a snapshot decompressed, as the real API serves it."""
+        if path is None:
+            self.send_error(404)
+            return
+        with open_xml(path) as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port: int = 0, fixture_dir: str = FIXTURE_DIR, xml_dir: str = XML_DIR, handler=StubHandler):
+    """Serve the fixtures from a background thread; returns (server, base_url).
+
+    `port` 0 picks a free port. `handler` may be a `StubHandler` subclass,
+    e.g. one that injects failures. Call `server.shutdown()` when done.
+    """
+    handler = type("Handler", (handler,), {"fixture_dir": Path(fixture_dir), "xml_dir": Path(xml_dir)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api"
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    server, base_url = start_stub_server(port)
+    print(f"Serving eCFR stub at {base_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the api modules import each other as top-level modules, as when run from api/
+sys.path.insert(0, API_DIR)
+
+from sqlmodel import create_engine  # noqa: E402
+from models import create_db_and_tables  # noqa: E402
+
+TITLE1_DIR = os.path.join(API_DIR, "xml_data", "title1")
+TITLE1_CHAPTERS = ["0", "I", "II", "III", "IV", "VI"]
+
+
+def chapter_agencies(title_id: int = 1, chapters=TITLE1_CHAPTERS) -> list:
+    """One agency per chapter, in the eCFR /agencies.json shape `load_agencies` reads."""
+    return [dict(slug=f"chapter-{chapter.lower()}", name=f"Chapter {chapter}", short_name=f"CH{chapter}",
+                 display_name=f"Chapter {chapter}", sortable_name=f"Chapter {chapter}",
+                 cfr_references=[dict(title=title_id, chapter=chapter)], children=[])
+            for chapter in chapters]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """An empty database with the current schema."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_db_and_tables(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def xml_dir(tmp_path, monkeypatch):
+    """An empty XML cache that the ingestion functions read from; returns its title 1 directory."""
+    import fetch_data
+
+    root = tmp_path / "xml_data"
+    (root / "title1").mkdir(parents=True)
+    monkeypatch.setattr(fetch_data, "XML_Data_DIR", str(root))
+    return root / "title1"
+
+
+def copy_snapshots(dest, count: int = None) -> list:
+    """Copy the first `count` bundled title 1 snapshots into `dest`; returns their paths."""
+    from parser import xml_files
+
+    paths = []
+    for path in xml_files(TITLE1_DIR)[:count]:
+        paths.append(shutil.copy(path, dest))
+    return paths
+
+
+@pytest.fixture
+def title1_engine(engine, xml_dir):
+    """A database with agencies and the first three title 1 snapshots ingested."""
+    from fetch_data import _snapshot_date, load_agencies, process_title_xml
+
+    load_agencies(engine, chapter_agencies())
+    for path in copy_snapshots(xml_dir, 3):
+        process_title_xml(engine, 1, _snapshot_date(path))
+    return engine
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+from conftest import chapter_agencies, copy_snapshots
+from fetch_data import _snapshot_date, process_title_xml
+from metrics import compute_metric
+from models import create_read_engine
+
+START, END = datetime(2000, 1, 1), datetime(2030, 1, 1)
+AGENCIES = ",".join(agency["short_name"] for agency in chapter_agencies())
+
+
+def _params(**page) -> dict:
+    return dict(metric_name="Word count", level=3, start_dt=START.isoformat(), end_dt=END.isoformat(),
+                agencies=AGENCIES, **page)
+
+
+@pytest.fixture
+def client(title1_engine, monkeypatch):
+    """A client for the API reading the title 1 test database through its own read-only pool."""
+    compute_metric(title1_engine, 1, START, END)
+    read_engine = create_read_engine(title1_engine.url.database)
+    monkeypatch.setattr(app, "engine", title1_engine)
+    monkeypatch.setattr(app, "read_engine", read_engine)
+    monkeypatch.setattr(app, "response_cache", app.ResponseCache())
+    # no `with`: the startup hook would create the schema in the default database
+    yield TestClient(app.app)
+    read_engine.dispose()
+
+
+def _ingest_next_snapshot(engine, xml_dir):
+    """Ingest and compute the fourth bundled snapshot, which bumps the data version."""
+    path = copy_snapshots(xml_dir, 4)[-1]
+    process_title_xml(engine, 1, _snapshot_date(path))
+    compute_metric(engine, 1, START, END)
+
+
+def test_responses_are_cached_until_the_data_version_changes(client, title1_engine, xml_dir):
+    first = client.get("/metric_json/", params=_params())
+    assert first.status_code == 200 and first.json()
+    etag = first.headers["etag"]
+
+    again = client.get("/metric_json/", params=_params())
+    assert again.headers["etag"] == etag and again.content == first.content
+    assert (app.response_cache.hits, app.response_cache.misses) == (1, 1)
+    assert client.get("/metric_json/", params=_params(), headers={"If-None-Match": etag}).status_code == 304
+
+    _ingest_next_snapshot(title1_engine, xml_dir)
+
+    changed = client.get("/metric_json/", params=_params(), headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+    assert {row["Date"] for row in changed.json()} > {row["Date"] for row in first.json()}
+    assert client.get("/metric_json/", params=_params(),
+                      headers={"If-None-Match": changed.headers["etag"]}).status_code == 304
+
+
+def test_cursor_pages_cover_the_whole_table(client, title1_engine, xml_dir):
+    rows = client.get("/metric_json/", params=_params(order_by="-value")).json()
+    pages = []
+    after = None
+    while True:
+        response = client.get("/metric_json/", params=_params(order_by="-value", limit=5,
+                                                                **({"after": after} if after else {})))
+        assert response.status_code == 200
+        pages.append(response)
+        after = response.headers.get("x-next-cursor")
+        if after is None:
+            break
+    assert len(pages) > 2 and all(len(page.json()) == 5 for page in pages[:-1])
+    assert [row for page in pages for row in page.json()] == rows
+
+    # each page is cached and revalidated on its own, and invalidated by new data
+    second = pages[1]
+    params = _params(order_by="-value", limit=5, after=pages[0].headers["x-next-cursor"])
+    assert client.get("/metric_json/", params=params, headers={"If-None-Match": second.headers["etag"]}).status_code == 304
+    assert second.headers["etag"] != pages[0].headers["etag"]
+    _ingest_next_snapshot(title1_engine, xml_dir)
+    assert client.get("/metric_json/", params=params, headers={"If-None-Match": second.headers["etag"]}).status_code == 200
+
+
+def test_top_n_keeps_the_largest_values_per_date(client):
+    rows = client.get("/metric_json/", params=_params()).json()
+    top = client.get("/metric_json/", params=_params(top_n=2))
+    assert top.status_code == 200
+
+    expected = {}
+    for row in rows:
+        expected.setdefault(row["Date"], []).append(row["Value"])
+    assert sorted((row["Date"], row["Value"]) for row in top.json()) == sorted(
+        (date, value) for date, values in expected.items() for value in sorted(values, reverse=True)[:2])
+    assert top.headers["etag"] != client.get("/metric_json/", params=_params(top_n=3)).headers["etag"]
+    assert client.get("/metric_json/", params=_params(top_n=2),
+                      headers={"If-None-Match": top.headers["etag"]}).status_code == 304
@@ -0,0 +1,49 @@
+from citations import citation_depths, extract_citations, section_citations
+
+
+def test_extract_citations_forms():
+    text = ("See § 51.5(b)(2), §§ 18.5 and 18.6, parts 9, 10, or 11 of this chapter, "
+            "40 CFR 52.21 and 1 CFR part 22, and 36 CFR parts 1252-1254.")
+    assert extract_citations(text) == {
+        (None, "section", "51.5"), (None, "section", "18.5"), (None, "section", "18.6"),
+        (None, "part", "9"), (None, "part", "10"), (None, "part", "11"),
+        (40, "section", "52.21"), (1, "part", "22"),
+        (36, "part", "1252"), (36, "part", "1253"), (36, "part", "1254"),
+    }
+    assert extract_citations("5 U.S.C. 552 (1 CFR Ch. I)") == set()
+
+
+def test_section_citations_resolve_own_title_and_drop_self():
+    citations = extract_citations("This § 1.1 and § 1.2 apply; see 2 CFR 200.1.")
+    assert section_citations(1, "1.1", citations) == {(1, "section", "1.2"), (2, "section", "200.1")}
+
+
+def test_citation_depth_chains_and_parts():
+    parts = {"1.1": 1, "1.2": 1, "2.1": 2, "3.1": 3, "3.2": 3}
+    edges = {
+        "1.1": {(1, "section", "1.2")},
+        "1.2": {(1, "part", "2")},          # reaches 2.1 through its part
+        "2.1": {(40, "section", "52.21")},  # outside the snapshot
+        "3.1": {(1, "part", "3")},          # its own part, ignored
+    }
+    assert citation_depths(1, parts, edges) == {"1.1": 3, "1.2": 2, "2.1": 1, "3.1": 0, "3.2": 0}
+
+
+def test_citation_depth_of_a_cycle_is_never_below_a_single_citation():
+    parts = {"1.1": 1, "2.1": 2}
+    one_way = citation_depths(1, parts, {"1.1": {(1, "section", "2.1")}})
+    mutual = citation_depths(1, parts, {"1.1": {(1, "section", "2.1")}, "2.1": {(1, "section", "1.1")}})
+    assert one_way == {"1.1": 1, "2.1": 0}
+    assert mutual == {"1.1": 1, "2.1": 1}
+
+
+def test_citation_depth_through_a_cycle():
+    parts = {"1.1": 1, "1.2": 1, "1.3": 1, "2.1": 2, "9.1": 9}
+    edges = {
+        "1.1": {(1, "section", "1.2")},
+        "1.2": {(1, "section", "1.3")},
+        "1.3": {(1, "section", "1.1"), (1, "section", "2.1")},
+        "2.1": {(1, "part", "9")},
+        "9.1": {(40, "section", "52.21")},
+    }
+    assert citation_depths(1, parts, edges) == {"1.1": 3, "1.2": 3, "1.3": 3, "2.1": 2, "9.1": 1}
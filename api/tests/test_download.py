@@ -0,0 +1,179 @@
+import asyncio
+import os
+from datetime import date, datetime
+
+import pytest
+
+import fetch_data
+from conftest import API_DIR, TITLE1_DIR, chapter_agencies
+from fetch_data import _get_xml_path, download_title_versions, download_title_xml_bulk, load_agencies, plan_snapshots, sync_title
+from metrics import compute_metric_parallel
+from parser import open_xml
+from stub_ecfr import StubHandler, start_stub_server
+
+ISSUE_DATE = date(2017, 1, 23)
+
+
+class CountingHandler(StubHandler):
+    """Records the paths it is asked for."""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        super().do_GET()
+
+
+class RateLimitedHandler(CountingHandler):
+    """Answers the first request with a 429 and a Retry-After."""
+
+    def do_GET(self):
+        if not self.requests:
+            self.requests.append(self.path)
+            self.send_response(429)
+            self.send_header("Retry-After", "0.05")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_GET()
+
+
+class DisconnectingHandler(CountingHandler):
+    """Promises a full body, sends part of it and drops the connection."""
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", "1000000")
+        self.end_headers()
+        self.wfile.write(b"<ECFR>" + b" " * 100_000)
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FailingSnapshotHandler(CountingHandler):
+    """Drops the connection partway through one snapshot; everything else is served normally."""
+    failing = "/full/2017-03-14/"
+
+    def do_GET(self):
+        if self.failing in self.path:
+            DisconnectingHandler.do_GET(self)
+            return
+        super().do_GET()
+
+
+@pytest.fixture
+def stub(xml_dir):
+    """Start a stub eCFR server with a given handler; returns its base url and the requests it saw."""
+    servers = []
+
+    def start(handler):
+        handler = type(handler.__name__, (handler,), {"requests": []})
+        server, base_url = start_stub_server(fixture_dir=os.path.join(API_DIR, "fixtures"),
+                                             xml_dir=os.path.join(API_DIR, "xml_data"), handler=handler)
+        servers.append(server)
+        return base_url, server.RequestHandlerClass.requests
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _download(base_url, title_dates, **kwargs) -> dict:
+    return asyncio.run(download_title_xml_bulk(title_dates, base_url=base_url, **kwargs))
+
+
+def test_retries_a_429_after_its_retry_after(stub, monkeypatch):
+    base_url, requests = stub(RateLimitedHandler)
+    delays = []
+    retry_delay = fetch_data._retry_delay
+    monkeypatch.setattr(fetch_data, "_retry_delay", lambda *args: delays.append(retry_delay(*args)) or delays[-1])
+
+    # without Retry-After a backoff of 60s would stall the test
+    stats = _download(base_url, [(1, ISSUE_DATE)], retries=2, backoff=60)
+
+    assert stats["downloaded"] == 1 and stats["failed"] == 0
+    assert len(requests) == 2 and delays == [0.05]
+    with open_xml(_get_xml_path(1, ISSUE_DATE)) as f, open_xml(os.path.join(TITLE1_DIR, "title-1_2017-01-23.xml")) as g:
+        assert f.read() == g.read()
+
+
+def test_a_dropped_connection_leaves_no_partial_file(stub, xml_dir):
+    base_url, requests = stub(DisconnectingHandler)
+
+    stats = _download(base_url, [(1, ISSUE_DATE)], retries=1, backoff=0)
+
+    assert stats["failed"] == 1 and len(requests) == 2
+    assert os.listdir(xml_dir) == []
+
+
+def test_a_404_fails_without_retrying(stub, xml_dir):
+    base_url, requests = stub(CountingHandler)
+
+    # no snapshot of title 1 is bundled from before 2015
+    stats = _download(base_url, [(1, date(2000, 1, 1))], retries=3, backoff=60)
+
+    assert stats["failed"] == 1 and len(requests) == 1
+    assert os.listdir(xml_dir) == []
+
+
+def test_existing_files_are_not_downloaded_again(stub):
+    base_url, requests = stub(CountingHandler)
+    path = _get_xml_path(1, ISSUE_DATE)
+    path.write_bytes(b"<ECFR/>")
+
+    stats = _download(base_url, [(1, ISSUE_DATE)])
+
+    assert stats["skipped"] == 1 and stats["downloaded"] == 0 and requests == []
+    assert path.read_bytes() == b"<ECFR/>"
+
+
+def _snapshots(xml_dir) -> list:
+    return sorted(name.split("_")[1][:10] for name in os.listdir(xml_dir))
+
+
+def test_plan_covers_a_range_with_its_baseline_snapshot(stub, engine):
+    base_url, _ = stub(CountingHandler)
+    asyncio.run(download_title_versions(engine, 1, base_url))
+
+    # nothing changes between 2018-05-02 and 2022-05-04, so that snapshot alone covers 2019-2021
+    plan = plan_snapshots(engine, 1, datetime(2019, 1, 1), datetime(2021, 12, 31))
+
+    assert plan == [dict(title_id=1, issue_date=datetime(2018, 5, 2), parts=[426], downloaded=False, ingested=False)]
+
+
+def test_sync_rerun_downloads_and_recomputes_nothing(stub, engine, xml_dir):
+    base_url, requests = stub(CountingHandler)
+    load_agencies(engine, chapter_agencies())
+    start, end = datetime(2015, 1, 1), datetime(2017, 12, 31)
+
+    assert asyncio.run(sync_title(engine, 1, start, end, base_url)) == dict(dates=5, downloaded=5, ingested=5)
+    assert compute_metric_parallel(engine, [1], start, end, workers=1)["rows"] > 0
+    files = {name: os.stat(xml_dir / name).st_mtime_ns for name in os.listdir(xml_dir)}
+    requests.clear()
+
+    assert asyncio.run(sync_title(engine, 1, start, end, base_url)) == dict(dates=5, downloaded=0, ingested=0)
+    assert compute_metric_parallel(engine, [1], start, end, workers=1)["shards"] == 0
+    assert requests == ["/api/versioner/v1/versions/title-1.json"]
+    assert {name: os.stat(xml_dir / name).st_mtime_ns for name in os.listdir(xml_dir)} == files
+
+
+def test_sync_leaves_no_partial_file_for_a_failed_snapshot(stub, engine, xml_dir, monkeypatch):
+    base_url, requests = stub(FailingSnapshotHandler)
+    monkeypatch.setattr(fetch_data, "_retry_delay", lambda *args: 0)
+    load_agencies(engine, chapter_agencies())
+    start, end = datetime(2015, 1, 1), datetime(2017, 12, 31)
+
+    assert asyncio.run(sync_title(engine, 1, start, end, base_url)) == dict(dates=5, downloaded=4, ingested=4)
+
+    # every retry was cut off as well
+    assert sum("/full/2017-03-14/" in path for path in requests) == 5
+    assert _snapshots(xml_dir) == ["2015-12-18", "2017-01-23", "2017-10-20", "2017-10-30"]
+    plan = {snapshot["issue_date"]: snapshot["ingested"] for snapshot in plan_snapshots(engine, 1, start, end)}
+    assert [issue_date for issue_date, ingested in plan.items() if not ingested] == [datetime(2017, 3, 14)]
+
+    # the next sync fetches just the missing snapshot
+    base_url, requests = stub(CountingHandler)
+    assert asyncio.run(sync_title(engine, 1, start, end, base_url)) == dict(dates=5, downloaded=1, ingested=1)
+    assert requests[1:] == ["/api/versioner/v1/full/2017-03-14/title-1.xml"]
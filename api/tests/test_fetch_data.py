@@ -0,0 +1,70 @@
+import multiprocessing
+from datetime import datetime
+
+from sqlmodel import Session, create_engine, func, select
+
+from conftest import chapter_agencies, copy_snapshots
+import fetch_data
+from fetch_data import _get_slug_dict, _snapshot_date, load_agencies, plan_ingest, process_title_xml, process_title_xml_bulk
+from models import CfrDimension, CfrText
+
+
+def _sections(engine, issue_date) -> int:
+    with Session(engine) as session:
+        return session.exec(select(func.count()).select_from(CfrText).where(CfrText.issue_date == issue_date)).one()
+
+
+def test_bulk_ingest_writes_nothing_from_a_file_that_fails_to_parse(engine, xml_dir):
+    load_agencies(engine, chapter_agencies())
+    good, broken = copy_snapshots(xml_dir, 2)
+    with open(broken, "rb") as f:
+        data = f.read()
+    # cut the second snapshot off partway, after some sections have been read
+    with open(broken, "wb") as f:
+        f.write(data[:len(data) // 2])
+    good_date, broken_date = _snapshot_date(good), _snapshot_date(broken)
+
+    stats = process_title_xml_bulk(engine, [(1, good_date), (1, broken_date)], workers=2, chunk_size=10)
+
+    assert stats["files"] == 1 and stats["errors"] == 1
+    assert _sections(engine, good_date) == stats["sections"] > 0
+    assert _sections(engine, broken_date) == 0
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(CfrDimension)
+                            .where(CfrDimension.issue_date == broken_date)).one() == 0
+    plan = {unit["issue_date"]: unit["done"] for unit in plan_ingest(engine, 1, datetime(2000, 1, 1), datetime(2030, 1, 1))}
+    assert plan == {good_date: True, broken_date: False}
+
+
+
+def _reload_agencies(url: str, chapters: list):
+    engine = create_engine(url)
+    load_agencies(engine, chapter_agencies(chapters=chapters))
+    engine.dispose()
+
+
+def test_slug_cache_follows_agencies_reloaded_elsewhere(engine):
+    load_agencies(engine, chapter_agencies(chapters=["I"]))
+    assert _get_slug_dict(engine) == {"1:I": "chapter-i"}
+
+    # another process reloads the agencies, so this process's cache is stale
+    process = multiprocessing.get_context("spawn").Process(target=_reload_agencies,
+                                                             args=(str(engine.url), ["I", "II"]))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    assert _get_slug_dict(engine) == {"1:I": "chapter-i", "1:II": "chapter-ii"}
+
+
+def test_ingesting_does_not_rebuild_the_slug_index(engine, xml_dir, monkeypatch):
+    load_agencies(engine, chapter_agencies())
+    fetch_data._slug_dicts.clear()
+    builds = []
+    slug_index = fetch_data._slug_index
+    monkeypatch.setattr(fetch_data, "_slug_index", lambda references: builds.append(1) or slug_index(references))
+
+    for path in copy_snapshots(xml_dir, 3):
+        process_title_xml(engine, 1, _snapshot_date(path))
+
+    assert len(builds) == 1
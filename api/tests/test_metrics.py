@@ -0,0 +1,102 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlmodel import Session, func, select
+
+from conftest import TITLE1_DIR, chapter_agencies
+
+import metrics
+from citations import extract_citations
+from models import CfrContent, CfrMetric, CfrText
+from parser import StreamingTitleXMLParser, xml_files
+
+START, END = datetime(2000, 1, 1), datetime(2030, 1, 1)
+
+
+def test_citations_are_extracted_once_per_body(title1_engine, monkeypatch):
+    calls = []
+    monkeypatch.setattr(metrics, "extract_citations", lambda text: calls.append(text) or extract_citations(text))
+
+    metrics.compute_metric(title1_engine, 1, START, END)
+
+    with Session(title1_engine) as session:
+        bodies = dict(session.exec(select(CfrContent.content_hash, CfrContent.content)).all())
+        issue_date = session.exec(select(func.max(CfrText.issue_date))).one()
+        texts = dict(session.exec(select(CfrText.section_id, CfrText.content_hash)
+                                  .where(CfrText.issue_date == issue_date)).all())
+        values = dict(session.exec(select(CfrMetric.section_id, CfrMetric.value)
+                                   .where(CfrMetric.metric_id == metrics.METRICS_MAP["cross-references Average"],
+                                          CfrMetric.issue_date == issue_date)).all())
+    assert sorted(calls) == sorted(bodies.values())
+    assert values == {section_id: len(extract_citations(bodies[content_hash])) for section_id, content_hash in texts.items()}
+
+
+def _term_counts(text: str) -> list:
+    values = metrics.compute_all(text, [metrics.TERM_METRIC_BASE + idx for idx in range(len(metrics.TERMS))])
+    return [values[metrics.TERM_METRIC_BASE + idx] for idx in range(len(metrics.TERMS))]
+
+
+def test_term_metrics_count_exactly_like_str_count():
+    texts = [row["text"] for path in xml_files(TITLE1_DIR) for row in StreamingTitleXMLParser(path)]
+    # overlapping, adjacent, case-variant and partial occurrences
+    texts += ["", "shallshall", "Shall SHALL shall", "mustn't must", "§§ 1.1", "U.S.C.U.S.C. U.S.C", "CFRCFR cfr"]
+    assert sum(map(sum, map(_term_counts, texts))) > 0
+    for text in texts:
+        assert _term_counts(text) == [text.count(term) for term in metrics.TERMS]
+
+
+def _query_plans(engine, run) -> list:
+    """EXPLAIN QUERY PLAN of each statement `run()` sends, with its bound parameters, as (statement, plan)."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "INSERT", "DELETE", "WITH")):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        run()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    with engine.connect() as conn:
+        return [(statement, "\n".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}",
+                                                                              parameters)))
+                for statement, parameters in statements]
+
+
+def _query_plan(engine, query) -> str:
+    def run():
+        with Session(engine) as session:
+            session.exec(query).all()
+
+    return _query_plans(engine, run)[-1][1]
+
+
+def test_table_queries_use_their_indexes(title1_engine):
+    metrics.compute_metric(title1_engine, 1, START, END)
+    agencies = [agency["short_name"] for agency in chapter_agencies()]
+
+    section_plan = _query_plan(title1_engine, metrics._table_query(title1_engine, 0, agencies, 5, START, END))
+    rollup_plan = _query_plan(title1_engine, metrics._table_query(title1_engine, 0, agencies, 1, START, END))
+    assert "USING COVERING INDEX ix_cfrmetric_metric_date" in section_plan
+    assert "SEARCH cfrmetric" in section_plan
+    assert "SEARCH metricrollup USING INDEX sqlite_autoindex_metricrollup_1" in rollup_plan
+
+
+def test_shard_reads_and_rollups_search_by_title_and_date(title1_engine):
+    plans = _query_plans(title1_engine, lambda: metrics.compute_metric(title1_engine, 1, START, END))
+
+    title_only = re.compile(r"(SCAN|SEARCH) (cfrmetric|cfrtext|cfrdimension)\b(?!.*issue_date)")
+    assert plans and [plan for _, plan in plans if title_only.search(plan)] == []
+    assert any("ix_cfrmetric_title_date" in plan for _, plan in plans)
+
+
+def test_compute_marks_every_shard_done(title1_engine):
+    assert not any(shard["done"] for shard in metrics.plan_compute(title1_engine, [1], START, END))
+
+    metrics.compute_metric(title1_engine, 1, START, END)
+
+    shards = metrics.plan_compute(title1_engine, [1], START, END)
+    assert len(shards) == 3 and all(shard["done"] for shard in shards)
+    assert metrics.compute_metric_parallel(title1_engine, [1], START, END, workers=1)["rows"] == 0
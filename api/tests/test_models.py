@@ -0,0 +1,77 @@
+import sqlite3
+
+from datetime import datetime
+
+from sqlmodel import Session, create_engine, delete, select
+
+import metrics
+from models import MetricRollup, create_db_and_tables, hash_content
+
+# cfrtext and cfrmetric as databases created before section text moved to CfrContent
+BASELINE_SCHEMA = """
+CREATE TABLE cfrtext (
+    title_id INTEGER NOT NULL,
+    section_id VARCHAR NOT NULL,
+    issue_date DATETIME NOT NULL,
+    content VARCHAR NOT NULL,
+    PRIMARY KEY (title_id, section_id, issue_date)
+);
+CREATE TABLE cfrmetric (
+    title_id INTEGER NOT NULL,
+    section_id VARCHAR NOT NULL,
+    issue_date DATETIME NOT NULL,
+    metric_id INTEGER NOT NULL,
+    value FLOAT NOT NULL,
+    PRIMARY KEY (title_id, section_id, issue_date, metric_id)
+);
+"""
+
+
+def test_create_db_and_tables_migrates_text_from_before_cfrcontent(tmp_path):
+    path = tmp_path / "old.db"
+    rows = [
+        (1, "1.1", "2022-01-01 00:00:00.000000", "Definitions apply."),
+        (1, "1.2", "2022-01-01 00:00:00.000000", "Scope of this part."),
+        (1, "1.1", "2023-01-01 00:00:00.000000", "Definitions apply."),
+    ]
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany("INSERT INTO cfrtext VALUES (?, ?, ?, ?)", rows)
+        conn.execute("INSERT INTO cfrmetric VALUES (1, '1.1', '2022-01-01 00:00:00.000000', 0, 2.0)")
+    conn.close()
+
+    engine = create_engine(f"sqlite:///{path}")
+    create_db_and_tables(engine)
+    # running it again on the migrated database is a no-op
+    create_db_and_tables(engine)
+    engine.dispose()
+
+    with sqlite3.connect(path) as conn:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(cfrtext)")}
+        texts = conn.execute(
+            "SELECT t.title_id, t.section_id, t.issue_date, c.content FROM cfrtext t "
+            "JOIN cfrcontent c USING (content_hash) ORDER BY t.issue_date, t.section_id").fetchall()
+        hashes = dict(conn.execute("SELECT content, content_hash FROM cfrcontent"))
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(cfrtext)")}
+        metrics = conn.execute("SELECT value FROM cfrmetric").fetchall()
+        keyword_rows = conn.execute("SELECT count(*) FROM cfrcontent_fts WHERE cfrcontent_fts MATCH 'definitions'").fetchone()
+    conn.close()
+    assert "content" not in columns and "content_hash" in columns
+    assert texts == sorted(rows, key=lambda row: (row[2], row[1]))
+    assert hashes == {content: hash_content(content) for content in ("Definitions apply.", "Scope of this part.")}
+    assert "ix_cfrtext_content_hash" in indexes
+    assert metrics == [(2.0,)]
+    assert keyword_rows == (1,)
+
+
+def test_create_db_and_tables_fills_rollups_computed_before_they_existed(title1_engine):
+    metrics.compute_metric(title1_engine, 1, datetime(2000, 1, 1), datetime(2030, 1, 1))
+    with Session(title1_engine) as session:
+        rollups = set(session.exec(select(*MetricRollup.__table__.c)).all())
+        session.exec(delete(MetricRollup))
+        session.commit()
+
+    create_db_and_tables(title1_engine)
+
+    with Session(title1_engine) as session:
+        assert set(session.exec(select(*MetricRollup.__table__.c)).all()) == rollups != set()
@@ -0,0 +1,73 @@
+from collections import Counter
+
+import pytest
+
+from conftest import TITLE1_DIR
+from parser import StreamingTitleXMLParser, TitleXMLParser, xml_files
+
+
+def _records(parser) -> Counter:
+    return Counter((tuple(sorted(row["keys"].items())), tuple(sorted(row["dims"].items())), row["text"])
+                   for row in parser)
+
+
+@pytest.mark.parametrize("file_path", xml_files(TITLE1_DIR), ids=lambda path: path.rsplit("_", 1)[1][:10])
+def test_streaming_parser_matches_tree_parser(file_path):
+    streamed = _records(StreamingTitleXMLParser(file_path))
+    assert streamed == _records(TitleXMLParser(file_path))
+    assert sum(streamed.values()) > 0
+
+
+SYNTHETIC = """<?xml version="1.0" encoding="UTF-8"?>
+<ECFR><DIV1 N="9" TYPE="TITLE"><HEAD>Title 9</HEAD>
+<DIV3 N="I" TYPE="CHAPTER"><HEAD>CHAPTER I</HEAD>
+<DIV5 N="1" TYPE="PART"><HEAD>PART 1</HEAD>
+<DIV8 N="1.1" TYPE="SECTION"><HEAD>§ 1.1</HEAD><P>No subchapter or subpart.</P></DIV8>
+</DIV5>
+<DIV4 N="A" TYPE="SUBCHAP"><HEAD>SUBCHAPTER A</HEAD>
+<DIV5 N="2" TYPE="PART"><HEAD>PART 2</HEAD>
+<DIV6 N="B" TYPE="SUBPART"><HEAD>Subpart B</HEAD>
+<DIV8 N="2.1" TYPE="SECTION"><HEAD>§ 2.1</HEAD><P>Under subchapter A, subpart B.</P></DIV8>
+</DIV6>
+</DIV5>
+</DIV4>
+<DIV5 N="3" TYPE="PART"><HEAD>PART 3</HEAD>
+{sections}
+</DIV5>
+</DIV3></DIV1></ECFR>
+"""
+
+
+@pytest.fixture
+def synthetic_xml(tmp_path):
+    path = tmp_path / "title-9_2024-01-01.xml"
+    sections = "\n".join(f'<DIV8 N="3.{i}" TYPE="SECTION"><HEAD>§ 3.{i}</HEAD><P>{"filler " * 100}</P></DIV8>'
+                         for i in range(1, 2001))
+    path.write_text(SYNTHETIC.format(sections=sections), encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize("parser_class", [TitleXMLParser, StreamingTitleXMLParser])
+def test_keys_come_from_the_sections_own_ancestors(synthetic_xml, parser_class):
+    rows = {row["keys"]["section"]: row for row in parser_class(synthetic_xml)}
+    assert rows["1.1"]["keys"] == {"title": "9", "chapter": "I", "part": "1", "section": "1.1"}
+    assert rows["2.1"]["keys"] == {"title": "9", "chapter": "I", "subchapter": "A", "part": "2",
+                                   "subpart": "B", "section": "2.1"}
+    assert rows["2.1"]["dims"]["subpart"] == "Subpart B"
+    assert "subchapter" not in rows["3.1"]["keys"] and "subpart" not in rows["3.1"]["dims"]
+
+
+def test_streaming_parser_yields_each_section_as_it_closes(synthetic_xml, monkeypatch):
+    import parser
+
+    opened = []
+
+    def tracked_open(file_path, mode="rb", compression=None):
+        opened.append(open(file_path, mode))
+        return opened[-1]
+
+    monkeypatch.setattr(parser, "open_xml", tracked_open)
+    rows = StreamingTitleXMLParser(synthetic_xml)
+    # 3.1 has no subchapter and no later element has one, yet it comes out without reading on to the end
+    assert next(row for row in rows if row["keys"]["section"] == "3.1")["text"].startswith("filler")
+    assert opened[0].tell() < len(open(synthetic_xml, "rb").read()) // 4